@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Natural sort: files.natural_sort against the original implementation
+
+usage: python benchmarks/bench_natural_sort.py [NUM_NAMES ...]
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eluminance.files as files
+
+
+def legacy_natural_sort(l):
+   convert = lambda text: int(text) if text.isdigit() else text.lower()
+   alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
+   return sorted(l, key=alphanum_key)
+
+def make_names(num, seed=42):
+    """ A shuffled mix of typical camera and user file names """
+    rnd = random.Random(seed)
+    patterns = ('IMG_%04d.JPG', 'DSC%05d.jpg', 'P%07d.jpg',
+                'holiday %d - beach.png', 'scan_%d_page_%d.tiff')
+    names = set()
+    while len(names) < num:
+        pat = rnd.choice(patterns)
+        args = tuple(rnd.randint(0, 99999) for _ in range(pat.count('%')))
+        names.add(pat % args)
+    names = list(names)
+    rnd.shuffle(names)
+    return names
+
+def timeit(func, *args):
+    t = time.time()
+    func(*args)
+    return time.time() - t
+
+def run(num):
+    names = make_names(num)
+    legacy = timeit(legacy_natural_sort, names)
+    cold = timeit(files.natural_sort, names)
+    return {
+        'names': num,
+        'legacy_s': legacy,
+        'cold_s': cold,
+        'cold_speedup': legacy / cold,
+    }
+
+def main():
+    for num in map(int, sys.argv[1:] or (100000, 1000000)):
+        res = run(num)
+        print('natural sort of {names} names: legacy {legacy_s:.3f}s, '
+              'cold {cold_s:.3f}s (x{cold_speedup:.1f})'.format(**res))
+
+if __name__ == '__main__':
+    main()
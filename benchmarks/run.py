@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmark suite for the browse pipeline
+
+Build synthetic photo trees (see synth.py) and time the code paths used
+while browsing: natural sort, folder listing (as in tree_selected), tree
+population, header metadata reads and thumbnail generation.
+No display is needed. Results are saved as JSON, give a previous result
+file to --compare to see the differences.
+
+usage: python benchmarks/run.py [--sizes 1000,10000,100000] [--compare old.json]
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import time
+import heapq
+import shutil
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def timed(func, *args):
+    """ Run func(*args), return (elapsed seconds, result) """
+    t = timer()
+    res = func(*args)
+    return timer() - t, res
+
+def make_flat(tree, flat):
+    """ Hard link all the images of tree in the single folder flat """
+    if os.path.exists(flat):
+        return flat
+    os.makedirs(flat)
+    for folder, dirs, files in os.walk(tree):
+        if folder == flat:
+            continue
+        prefix = os.path.relpath(folder, tree).replace(os.sep, '_')
+        for name in files:
+            if not name.startswith('.'):
+                os.link(os.path.join(folder, name),
+                        os.path.join(flat, prefix + '_' + name))
+    return flat
+
+def fresh_catalog(workdir):
+    from eluminance import catalog
+    db = os.path.join(workdir, 'catalog.sqlite')
+    if catalog._instance is not None:
+        catalog._instance.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+    catalog._instance = catalog.Catalog(db)
+
+
+def bench_sort(res, names):
+    from eluminance import files
+    from bench_natural_sort import legacy_natural_sort
+    res['sort_legacy'], _ = timed(legacy_natural_sort, names)
+    res['sort_cold'], _ = timed(files.natural_sort, names)
+
+def bench_listing(res, workdir, flat):
+    """ tree_selected on a single folder with all the images """
+    from eluminance import files, scanner
+    fresh_catalog(workdir)
+
+    def first_screen():
+        images, folders = scanner.read_folder(flat)
+        return heapq.nsmallest(128, images, key=files.natural_key)
+    res['list_first_screen'], _ = timed(first_screen)
+    scanner._keys.clear()
+    res['list_cold'], _ = timed(scanner.scan_folder, flat)
+    res['list_catalog'], _ = timed(scanner.scan_folder, flat)
+    # read again after a change, the natural keys of the folder are kept
+    fresh_catalog(workdir)
+    res['list_changed'], _ = timed(scanner.scan_folder, flat)
+
+def bench_populate(res, workdir, tree, flat):
+    """ TreeView.populate on every folder of the tree """
+    from eluminance import files, scanner
+    folders = [f for f, _, _ in os.walk(tree)]
+
+    def legacy(path): # the original listdir + isdir implementation
+        return [f for f in files.natural_sort(os.listdir(path))
+                if f[0] != '.' and os.path.isdir(os.path.join(path, f))]
+    def populate_all(func):
+        for folder in folders:
+            func(folder)
+
+    res['populate_legacy'], _ = timed(populate_all, legacy)
+    fresh_catalog(workdir)
+    res['populate_cold'], _ = timed(populate_all, scanner.scan_folder)
+    res['populate_catalog'], _ = timed(populate_all, scanner.scan_folder)
+    # expanding the photo heavy folder
+    res['populate_flat_legacy'], _ = timed(legacy, flat)
+    fresh_catalog(workdir)
+    res['populate_flat_cold'], _ = timed(scanner.scan_folder, flat)
+
+def bench_metadata(res, images):
+    from eluminance import metadata
+    metadata._cache.clear()
+    res['metadata_read'], _ = timed(lambda: [metadata.get(p) for p in images])
+    res['metadata_cached'], _ = timed(lambda: [metadata.get(p) for p in images])
+
+def bench_model_sort(res, workdir, images):
+    """ FolderModel.sort, with a cold catalog then with all the metadata
+
+    The cold catalog only knows the paths, as just after a first scan.
+    """
+    from eluminance import catalog, metadata
+    from eluminance.model import FolderModel, SORT_MODES
+    fresh_catalog(workdir)
+    catalog.instance().images_seen(images)
+    model = FolderModel()
+    model.append(images)
+    for mode in SORT_MODES:
+        res['model_sort_cold_' + mode], _ = timed(model.sort, mode)
+    catalog.instance().images_set([metadata.read(p).to_row() for p in images])
+    for mode in SORT_MODES:
+        res['model_sort_' + mode], _ = timed(model.sort, mode)
+
+def bench_thumbnails(res, workdir, images, jobs_list):
+    from eluminance import thumbnails
+    if not thumbnails.available():
+        res['thumbnails'] = 'skipped: PIL not available'
+        return
+    res['thumbnails_count'] = len(images)
+    for jobs in jobs_list:
+        shutil.rmtree(thumbnails.THUMBS_DIR, ignore_errors=True)
+        pool = multiprocessing.Pool(jobs)
+        pool.map(abs, range(jobs)) # wait for the workers to be up
+        chunk = max(1, len(images) // (jobs * 8))
+        res['thumbnails_j%d' % jobs], _ = timed(pool.map,
+                                                thumbnails.thumb_generate,
+                                                images, chunk)
+        pool.terminate()
+    res['thumbnails_lookup'], _ = timed(
+        lambda: [thumbnails.thumb_lookup(p) for p in images])
+
+
+def run_size(size, workdir, thumb_limit, jobs_list):
+    import synth
+    tree = synth.make_tree(os.path.join(workdir, 'tree-%d' % size), size)
+    flat = make_flat(tree, os.path.join(workdir, 'flat-%d' % size))
+    images = sorted(os.path.join(flat, n) for n in os.listdir(flat)
+                    if not n.endswith('.txt'))
+    names = [os.path.basename(p) for p in images]
+
+    res = {}
+    bench_sort(res, names)
+    bench_listing(res, workdir, flat)
+    bench_populate(res, workdir, tree, flat)
+    bench_metadata(res, images)
+    bench_model_sort(res, workdir, images)
+    bench_thumbnails(res, workdir, images[:thumb_limit], jobs_list)
+    return res
+
+def system_info():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=BENCH_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        rev = None
+    return {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'git': rev,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+
+def print_results(results, previous=None):
+    for size, res in sorted(results.items(), key=lambda i: int(i[0])):
+        print('\n== %s images ==' % size)
+        prev = (previous or {}).get(size, {})
+        for name, val in sorted(res.items()):
+            if not isinstance(val, float):
+                print('  %-24s %s' % (name, val))
+                continue
+            line = '  %-24s %10.4fs' % (name, val)
+            if isinstance(prev.get(name), float) and val > 0:
+                line += '   (was %.4fs, x%.2f)' % (prev[name], prev[name] / val)
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Eluminance benchmarks')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated number of images per tree')
+    parser.add_argument('--workdir', default=os.path.join(
+                        os.path.expanduser('~'), '.cache', 'eluminance-bench'),
+                        help='where the synthetic trees are created (reused)')
+    parser.add_argument('--thumb-limit', type=int, default=1000,
+                        help='max number of thumbnails generated per size')
+    parser.add_argument('--jobs', default='1,%d' % multiprocessing.cpu_count(),
+                        help='comma separated thumbnails workers to try')
+    parser.add_argument('-o', '--output',
+                        help='result file (default: WORKDIR/results-DATE.json)')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='a previous result file to compare with')
+    args = parser.parse_args()
+
+    # keep the user config (catalog) and cache (thumbnails) untouched,
+    # this must be done before eluminance modules are imported
+    workdir = os.path.abspath(args.workdir)
+    os.environ['XDG_CONFIG_HOME'] = os.path.join(workdir, 'config')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    sys.path.insert(0, BENCH_DIR)
+
+    output = args.output or os.path.join(
+                 workdir, time.strftime('results-%Y%m%d-%H%M%S.json'))
+    jobs_list = sorted(set(int(j) for j in args.jobs.split(',')))
+    results = {}
+    for size in map(int, args.sizes.split(',')):
+        print('Running benchmarks with %d images...' % size)
+        results[str(size)] = run_size(size, workdir, args.thumb_limit,
+                                      jobs_list)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+
+    with open(output, 'w') as f:
+        json.dump({'system': system_info(), 'results': results}, f,
+                  indent=2, sort_keys=True)
+    print('\nResults saved to: %s' % output)
+
+if __name__ == '__main__':
+    main()
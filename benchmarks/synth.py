@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Synthetic photo trees for the benchmarks
+
+A tree looks like a real archive: ROOT/YEAR/EVENT/ with camera named jpegs
+(with an EXIF block) mixed with some png, and a few non image files.
+Images are tiny, real decodable files when PIL is available, otherwise
+only their headers are valid (enough for listing and metadata benchmarks).
+"""
+
+from __future__ import absolute_import, print_function
+
+import io
+import os
+import zlib
+import struct
+import random
+import shutil
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def _png_chunk(ctype, data):
+    crc = zlib.crc32(ctype + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', crc)
+
+def make_png(w, h, rgb=(128, 128, 128)):
+    """ A valid RGB png, without any dependency """
+    row = b'\0' + struct.pack('BBB', *rgb) * w
+    return (b'\x89PNG\r\n\x1a\n' +
+            _png_chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)) +
+            _png_chunk(b'IDAT', zlib.compress(row * h)) +
+            _png_chunk(b'IEND', b''))
+
+def _ifd(entries, offset):
+    """ A little endian IFD at offset, entries: [(tag, type, count, data)] """
+    data_off = offset + 2 + len(entries) * 12 + 4
+    out, extra = struct.pack('<H', len(entries)), b''
+    for tag, typ, count, val in sorted(entries):
+        if len(val) <= 4:
+            out += struct.pack('<HHI', tag, typ, count) + val.ljust(4, b'\0')
+        else:
+            out += struct.pack('<HHII', tag, typ, count, data_off + len(extra))
+            extra += val
+    return out + struct.pack('<I', 0) + extra
+
+def _ascii(tag, s):
+    s = s.encode('ascii') + b'\0'
+    return (tag, 2, len(s), s)
+
+def make_exif(make, model, date, lens, orientation=1):
+    """ An APP1 Exif payload with the usual camera fields """
+    ifd0 = [_ascii(0x010F, make), _ascii(0x0110, model),
+            (0x0112, 3, 1, struct.pack('<H', orientation)),
+            (0x8769, 4, 1, b'\0\0\0\0')]
+    exif_off = 8 + len(_ifd(ifd0, 8))
+    ifd0[-1] = (0x8769, 4, 1, struct.pack('<I', exif_off))
+    exif = [_ascii(0x9003, date), _ascii(0xA434, lens),
+            (0x829A, 5, 1, struct.pack('<II', 1, 250)),
+            (0x829D, 5, 1, struct.pack('<II', 56, 10)),
+            (0x8827, 3, 1, struct.pack('<H', 200)),
+            (0x920A, 5, 1, struct.pack('<II', 85, 1))]
+    tiff = b'II*\0' + struct.pack('<I', 8) + _ifd(ifd0, 8) + \
+           _ifd(exif, exif_off)
+    return b'Exif\0\0' + tiff
+
+def make_jpeg(w, h, exif, rgb=(128, 128, 128)):
+    """ A jpeg with the given exif payload """
+    app1 = b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif
+    if Image is not None:
+        buf = io.BytesIO()
+        Image.new('RGB', (w, h), rgb).save(buf, 'JPEG', quality=70)
+        data = buf.getvalue()
+        return data[:2] + app1 + data[2:]
+    # headers only: SOI, APP1, SOF0, SOS, EOI
+    sof = struct.pack('>HBHHB', 11, 8, h, w, 1) + b'\x01\x11\x00'
+    return b'\xff\xd8' + app1 + b'\xff\xc0' + sof + \
+           b'\xff\xda\x00\x02' + b'\xff\xd9'
+
+CAMERAS = (('Canon', 'Canon EOS 5D Mark III', 'IMG_%04d.JPG', 'EF85mm f/1.8'),
+           ('NIKON CORPORATION', 'NIKON D750', 'DSC_%04d.JPG', '50mm f/1.4'),
+           ('SONY', 'ILCE-7M3', 'DSC%05d.JPG', 'FE 24-70mm F2.8 GM'))
+
+def make_tree(root, num_images, per_folder=250, seed=1):
+    """ Create (or reuse) a tree with num_images images below root """
+    marker = os.path.join(root, '.synth-%d' % num_images)
+    if os.path.exists(marker):
+        return root
+    if os.path.exists(root): # an incomplete tree
+        shutil.rmtree(root)
+    rnd = random.Random(seed)
+    templates = [make_jpeg(64, 48, make_exif(make, model,
+                                             '2019:%02d:%02d 12:00:00' % (m, d),
+                                             lens), (m * 20, d * 8, 100))
+                 for (make, model, _, lens), m, d in
+                 zip(CAMERAS * 4, range(1, 13), range(1, 29, 2))]
+    png = make_png(64, 48)
+
+    done = 0
+    folder_num = 0
+    while done < num_images:
+        year = 2000 + folder_num // 20
+        folder = os.path.join(root, str(year), 'event %03d' % folder_num)
+        os.makedirs(folder)
+        n = min(per_folder, num_images - done)
+        make, model, pattern, lens = CAMERAS[folder_num % len(CAMERAS)]
+        for i in range(n):
+            if i % 10 == 9:
+                name, data = 'export %d.png' % i, png
+            else:
+                name, data = pattern % (i + 1), rnd.choice(templates)
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(folder, 'notes.txt'), 'w') as f:
+            f.write('not an image')
+        done += n
+        folder_num += 1
+
+    open(marker, 'w').close()
+    return root
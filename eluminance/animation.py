@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Frame by frame playback of animated images
+
+Evas keep every decoded frame of the animations it plays, that's fine for
+small ones but a long animation of big frames can take hundreds of MB.
+Those are played here instead: every frame is decoded by PIL when it is
+due, and given to the image as an in-memory PNG that replaces the previous
+one, so only one frame is kept whatever the length of the animation.
+"""
+
+from __future__ import absolute_import, print_function
+
+import io
+
+from efl import ecore
+
+import eluminance.archives as archives
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+MIN_DURATION = 0.02 # seconds, for frames without a delay (as browsers do)
+PNG_LEVEL = 1 # zlib level of the frames, fast to encode and to decode
+
+
+def available():
+    """ True if animations can be played frame by frame (PIL is installed) """
+    return Image is not None
+
+def frames_size(width, height, count):
+    """ Bytes needed to keep all the decoded frames of an animation """
+    return width * height * 4 * count
+
+
+class FramePlayer(object):
+    """ Play the animated image at path in the elm.Image image
+
+    Frames are scaled to the current object_size of image, so that a reduced
+    decode stay reduced. The animation loop forever, as in elm.Image.
+    """
+    def __init__(self, path, image):
+        self._image = image
+        self._size = image.object_size
+        self._src = Image.open(archives.open(path))
+        self._timer = None
+
+    def play(self):
+        if self._timer is None:
+            self._timer = ecore.Timer(self._frame_show(), self._timer_cb)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.delete()
+            self._timer = None
+
+    def close(self):
+        self.stop()
+        self._src.close()
+
+    def _frame_show(self):
+        """ Show the current frame, return its duration in seconds """
+        frame = self._src.convert('RGBA')
+        if frame.size != self._size:
+            frame = frame.resize(self._size, Image.BILINEAR)
+        buf = io.BytesIO()
+        frame.save(buf, 'PNG', compress_level=PNG_LEVEL)
+        data = buf.getvalue()
+        self._image.memfile_set(data, len(data), 'png')
+        return max(self._src.info.get('duration', 0) / 1000.0, MIN_DURATION)
+
+    def _timer_cb(self):
+        try:
+            self._src.seek(self._src.tell() + 1)
+        except EOFError:
+            self._src.seek(0)
+        try:
+            self._timer.interval = self._frame_show()
+        except Exception as e:
+            print("ERROR: Cannot decode animation frame: %s" % e)
+            self._timer = None
+            return ecore.ECORE_CALLBACK_CANCEL
+        return ecore.ECORE_CALLBACK_RENEW
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Browse the images inside zip and tar archives, without extracting them
+
+Archives are shown as folders: the images inside them have virtual paths
+made of the archive path followed by the member name, for example
+~/comics/book.cbz/chapter1/page01.jpg
+
+Opening an archive only read its index (the central directory of zip files,
+the headers of tar files), members are then read by random access from a
+memory map of the archive, so that only the bytes of the requested member
+are touched. Deflated zip members are inflated from the same file. A few
+archives are kept open, the least recently used ones are closed.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import io
+import mmap
+import struct
+import tarfile
+import zipfile
+import threading
+from collections import OrderedDict
+
+import eluminance.files as files
+
+
+ARCHIVE_EXTS = ('.zip', '.cbz', '.tar', '.cbt')
+MAX_OPEN = 4 # archives kept open
+
+
+def is_archive(name):
+    return os.path.splitext(name)[-1].lower() in ARCHIVE_EXTS
+
+def split(path):
+    """ Return (archive, member) if path is inside an archive, else None
+
+    member is '' for the archive itself, that is shown as a folder.
+    """
+    pos = path.find(os.sep, 1)
+    while True:
+        head = path if pos < 0 else path[:pos]
+        if is_archive(head) and os.path.isfile(head):
+            return head, '' if pos < 0 else path[pos + 1:]
+        if pos < 0:
+            return None
+        pos = path.find(os.sep, pos + 1)
+
+
+class MemberStat(object):
+    """ The os.stat fields used for the members: archive mtime, data size """
+    __slots__ = ('st_mtime', 'st_size')
+
+    def __init__(self, mtime, size):
+        self.st_mtime = mtime
+        self.st_size = size
+
+
+class Archive(object):
+    """ The index of an archive, and random access to its members """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self._lock = threading.Lock()
+        self._file = io.open(path, 'rb')
+        self._map = None
+        self._zip = None
+        self._members = {} # name -> (ZipInfo or data offset, data size)
+        self._dirs = {}    # folder name -> ([images], [folders]), '' is root
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            if zipfile.is_zipfile(self._file):
+                self._zip = zipfile.ZipFile(self._file)
+                for info in self._zip.infolist():
+                    if not info.filename.endswith('/'):
+                        self._members[info.filename] = (info, info.file_size)
+            else:
+                self._file.seek(0)
+                with tarfile.open(fileobj=self._file, mode='r:') as tar:
+                    for info in tar:
+                        if info.isfile():
+                            self._members[info.name] = (info.offset_data,
+                                                        info.size)
+        except Exception:
+            self.close()
+            raise
+        self._dirs_build()
+
+    def _dirs_build(self):
+        folders = {'': set()}
+        images = {'': []}
+        for name in self._members:
+            parts = name.split('/')
+            if not files.is_image(parts[-1]):
+                continue
+            for i in range(len(parts) - 1):
+                parent = '/'.join(parts[:i])
+                folders.setdefault(parent, set()).add(parts[i])
+            images.setdefault('/'.join(parts[:-1]), []).append(parts[-1])
+        for folder in set(folders) | set(images):
+            self._dirs[folder] = (files.natural_sort(images.get(folder, [])),
+                                  files.natural_sort(folders.get(folder, [])))
+
+    def close(self):
+        # wait for the reads in progress in the other threads
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+            if self._map is not None:
+                self._map.close()
+            self._file.close()
+
+    def listdir(self, folder=''):
+        """ The natural sorted (images, folders) names in folder """
+        return self._dirs[folder.strip('/')]
+
+    def size(self, name):
+        return self._members[name][1]
+
+    def read(self, name):
+        """ The data of the member name """
+        where, size = self._members[name]
+        with self._lock:
+            if not isinstance(where, zipfile.ZipInfo):
+                return self._map[where:where+size]
+            if where.compress_type == zipfile.ZIP_STORED and \
+                    not where.flag_bits & 0x1:
+                # skip the local header, the data is right after it
+                h = where.header_offset
+                name_len, extra_len = struct.unpack('<HH',
+                                                    self._map[h+26:h+30])
+                start = h + 30 + name_len + extra_len
+                return self._map[start:start+size]
+            return self._zip.read(where)
+
+
+_open = OrderedDict() # archive path -> Archive, least recently used first
+_open_lock = threading.Lock()
+
+def archive_get(path):
+    """ The open Archive at path, opened again if changed """
+    mtime = os.stat(path).st_mtime
+    with _open_lock:
+        archive = _open.pop(path, None)
+        if archive is not None and archive.mtime != mtime:
+            archive.close()
+            archive = None
+        if archive is None:
+            try:
+                archive = Archive(path)
+            except (zipfile.BadZipfile, tarfile.TarError, ValueError) as e:
+                raise OSError("Cannot open archive '%s': %s" % (path, e))
+            while len(_open) >= MAX_OPEN:
+                _open.popitem(last=False)[1].close()
+        _open[path] = archive
+    return archive
+
+def _member(path):
+    parts = split(path)
+    if parts is None or not parts[1]:
+        return None, None
+    return archive_get(parts[0]), parts[1]
+
+def listdir(path):
+    """ The natural sorted (images, folders) names of an archive folder """
+    archive, folder = split(path)
+    try:
+        return archive_get(archive).listdir(folder)
+    except KeyError:
+        raise OSError("No such folder in archive: '%s'" % path)
+
+def stat(path):
+    """ os.stat(path), that also work for the members of the archives """
+    archive, name = _member(path)
+    if archive is None:
+        return os.stat(path)
+    try:
+        return MemberStat(archive.mtime, archive.size(name))
+    except KeyError:
+        raise OSError("No such file in archive: '%s'" % path)
+
+def read(path):
+    """ The data of the archive member at path """
+    archive, name = _member(path)
+    if archive is None:
+        raise IOError("Not inside an archive: '%s'" % path)
+    try:
+        return archive.read(name)
+    except KeyError:
+        raise IOError("No such file in archive: '%s'" % path)
+    except ValueError: # closed meanwhile, to open another archive
+        raise IOError("Archive closed while reading: '%s'" % path)
+
+def open(path):
+    """ open(path, 'rb'), that also work for the members of the archives """
+    if _member(path)[0] is None:
+        return io.open(path, 'rb')
+    return io.BytesIO(read(path))
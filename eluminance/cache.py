@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+from collections import OrderedDict
+
+import eluminance.perf as perf
+
+
+class LRUCache(object):
+    """ A least recently used cache limited by the total size of its items
+
+    When the size goes over max_bytes the oldest items are dropped, and
+    evict_cb(key, value) is called for each of them.
+    Hits, misses and evictions are counted in perf as NAME.hit and so on.
+    """
+    def __init__(self, max_bytes, evict_cb=None, name='cache'):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._evict_cb = evict_cb
+        self._items = OrderedDict()  # key -> (value, size), oldest first
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """ Return the value for key and mark it as the most recent one """
+        try:
+            value, size = self._items.pop(key)
+        except KeyError:
+            perf.count(self.name + '.miss')
+            return default
+        perf.count(self.name + '.hit')
+        self._items[key] = (value, size)
+        return value
+
+    def pop(self, key, default=None):
+        """ Remove key from the cache (without evicting it) """
+        try:
+            value, size = self._items.pop(key)
+        except KeyError:
+            return default
+        self.bytes -= size
+        return value
+
+    def put(self, key, value, size):
+        if key in self._items:
+            self.evict(key)
+        self._items[key] = (value, size)
+        self.bytes += size
+        self.shrink(self.max_bytes)
+
+    def evict(self, key):
+        value = self.pop(key)
+        perf.count(self.name + '.evict')
+        if self._evict_cb:
+            self._evict_cb(key, value)
+
+    def shrink(self, max_bytes):
+        """ Evict the oldest items until the size fits in max_bytes """
+        while self.bytes > max_bytes and self._items:
+            self.evict(next(iter(self._items)))
+
+    def clear(self):
+        self.shrink(0)
+
+
+class MemoryBudget(object):
+    """ A single limit for all the decoded pixels kept by the application
+
+    Holders register their entries with add(), giving the position of the
+    entry in the slideshow (or None) and a release_cb() that must free it.
+    When the total goes over max_bytes the entries furthest from the focus
+    position are released first. Entries without a release_cb are only
+    accounted, they are never evicted.
+    """
+    def __init__(self, max_bytes, name='budget'):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.focus_pos = 0
+        self.focus_count = 0 # distances wrap around when not 0
+        self._entries = {} # key -> (size, release_cb, position)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, key, size, release_cb=None, position=None):
+        self.remove(key)
+        self._entries[key] = (size, release_cb, position)
+        self.bytes += size
+        self.shrink(self.max_bytes)
+
+    def remove(self, key):
+        """ Forget key, without releasing it """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[0]
+
+    def focus(self, position, count=0):
+        """ Set the current slideshow position (count if it loops) """
+        self.focus_pos = position
+        self.focus_count = count
+        self.shrink(self.max_bytes)
+
+    def distance(self, position):
+        if position is None:
+            return 0
+        dist = abs(position - self.focus_pos)
+        if self.focus_count:
+            dist = min(dist, self.focus_count - dist)
+        return dist
+
+    def shrink(self, max_bytes):
+        """ Release the furthest entries until the total fits in max_bytes """
+        if self.bytes <= max_bytes:
+            return
+        victims = sorted((self.distance(pos), key)
+                         for key, (size, release_cb, pos)
+                         in self._entries.items() if release_cb is not None)
+        while self.bytes > max_bytes and victims:
+            key = victims.pop()[1]
+            release_cb = self._entries[key][1]
+            self.remove(key)
+            perf.count(self.name + '.evict')
+            release_cb()
+
+
+def memory_pressure(psi_limit=10.0, min_available=0.05):
+    """ True if the system is short of memory (only on linux)
+
+    Pressure is reported when the tasks stalled waiting for memory more than
+    psi_limit percent of the last 10 seconds (/proc/pressure/memory, linux
+    4.20+), or when less than min_available of the memory is available.
+    """
+    try:
+        with open('/proc/pressure/memory') as f:
+            for line in f:
+                if line.startswith('some'):
+                    avg10 = float(line.split()[1].split('=')[1])
+                    if avg10 > psi_limit:
+                        return True
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        info = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, val = line.split(':', 1)
+                info[name] = int(val.split()[0])
+        return info['MemAvailable'] < info['MemTotal'] * min_available
+    except (IOError, OSError, ValueError, KeyError):
+        return False
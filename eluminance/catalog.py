@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import sqlite3
+import threading
+from xdg.BaseDirectory import xdg_config_home
+
+
+catalog_file = os.path.join(xdg_config_home, 'eluminance', 'catalog.sqlite')
+
+# '/' is the only char (together with NUL) that cannot be in a file name
+SEP = '/'
+
+# the metadata of a single image, same order of metadata.Metadata
+IMAGE_COLUMNS = ('path', 'mtime', 'size', 'width', 'height', 'orientation',
+                 'date', 'make', 'model', 'lens', 'exposure', 'fnumber',
+                 'iso', 'focal')
+# mtime of the images seen in a folder but not read yet, never a file mtime
+UNKNOWN_MTIME = -1
+
+# search: free text columns, and the ones that can be compared with numbers
+SEARCH_TEXT = ('path', 'make', 'model', 'lens', 'date')
+SEARCH_NUMBERS = ('width', 'height', 'iso', 'focal', 'fnumber', 'size')
+SEARCH_KEYS = {'camera': '{make model}', 'make': 'make', 'model': 'model',
+               'lens': 'lens', 'name': 'path', 'path': 'path'}
+SEARCH_LIMIT = 10000
+
+
+class Catalog(object):
+    """ Persistent on-disk catalog of folders content
+
+    Every folder is stored with its sorted list of images and subfolders,
+    together with the mtime of the directory at the time it was read.
+    A cached listing is valid only while the directory mtime is unchanged.
+    For folders never listed only the fact that they contain subfolders
+    or not can be known, this is what the tree needs for the expanders.
+    The metadata of every image is stored too, as a row of IMAGE_COLUMNS,
+    valid while the image mtime is unchanged, and so are the perceptual
+    hashes used to find duplicates.
+    The images are indexed for the search: path, camera, lens and date in a
+    full text index (substrings, when sqlite has the FTS5 trigram tokenizer),
+    dimensions and the other numbers in plain indexes.
+    The catalog can be used from any thread.
+    """
+    def __init__(self, db_file=catalog_file):
+        db_path = os.path.dirname(db_file)
+        if not os.path.exists(db_path):
+            os.makedirs(db_path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_file, timeout=10.0,
+                                   check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS folders ('
+                             'path TEXT PRIMARY KEY, '
+                             'mtime REAL NOT NULL, '
+                             'images TEXT NOT NULL, '
+                             'folders TEXT NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS subfolders ('
+                             'path TEXT PRIMARY KEY, '
+                             'mtime REAL NOT NULL, '
+                             'has INTEGER NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS images ('
+                             'path TEXT PRIMARY KEY, mtime REAL NOT NULL, '
+                             'size INTEGER, width INTEGER, height INTEGER, '
+                             'orientation INTEGER, date TEXT, make TEXT, '
+                             'model TEXT, lens TEXT, exposure REAL, '
+                             'fnumber REAL, iso INTEGER, focal REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                             'path TEXT PRIMARY KEY, mtime REAL NOT NULL, '
+                             'dhash INTEGER NOT NULL)')
+            if self._db.execute('PRAGMA user_version').fetchone()[0] < 1:
+                # the folders listings did not include the archives
+                self._db.execute('DELETE FROM folders')
+                self._db.execute('DELETE FROM subfolders')
+                self._db.execute('PRAGMA user_version = 1')
+            for col in ('date', 'width', 'height', 'iso', 'focal'):
+                self._db.execute('CREATE INDEX IF NOT EXISTS images_%s '
+                                 'ON images (%s)' % (col, col))
+            self._fts = self._fts_create()
+
+    def _fts_create(self):
+        """ Create the full text index of the images, return its tokenizer
+
+        The index is kept in sync by triggers, the REPLACE of a row must fire
+        the delete one too. Return None if FTS5 is not available.
+        """
+        self._db.execute('PRAGMA recursive_triggers=ON')
+        row = self._db.execute("SELECT sql FROM sqlite_master "
+                               "WHERE name = 'images_fts'").fetchone()
+        if row is not None:
+            return 'trigram' if 'trigram' in row[0] else 'unicode61'
+        cols = ', '.join(SEARCH_TEXT)
+        for tokenizer in ('trigram', 'unicode61'):
+            try:
+                self._db.execute("CREATE VIRTUAL TABLE images_fts USING fts5("
+                                 "%s, content='images', content_rowid='rowid', "
+                                 "tokenize='%s')" % (cols, tokenizer))
+                break
+            except sqlite3.OperationalError:
+                continue
+        else:
+            return None
+        new = ', '.join('new.' + c for c in SEARCH_TEXT)
+        old = ', '.join('old.' + c for c in SEARCH_TEXT)
+        self._db.execute('CREATE TRIGGER images_fts_insert AFTER INSERT ON '
+                         'images BEGIN INSERT INTO images_fts (rowid, %s) '
+                         'VALUES (new.rowid, %s); END' % (cols, new))
+        self._db.execute('CREATE TRIGGER images_fts_delete AFTER DELETE ON '
+                         'images BEGIN INSERT INTO images_fts '
+                         "(images_fts, rowid, %s) VALUES ('delete', "
+                         'old.rowid, %s); END' % (cols, old))
+        # index the images already in the catalog
+        self._db.execute("INSERT INTO images_fts (images_fts) VALUES ('rebuild')")
+        return tokenizer
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def folder_get(self, path, mtime):
+        """ Return (images, folders) names of path, or None if unknown """
+        with self._lock:
+            row = self._db.execute('SELECT mtime, images, folders FROM folders '
+                                   'WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != mtime:
+            return None
+        return _unpack(row[1]), _unpack(row[2])
+
+    def folder_set(self, path, mtime, images, folders):
+        """ Store the (already sorted) content of path """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO folders '
+                             '(path, mtime, images, folders) '
+                             'VALUES (?, ?, ?, ?)',
+                             (path, mtime, SEP.join(images), SEP.join(folders)))
+            self._db.execute('INSERT OR REPLACE INTO subfolders '
+                             '(path, mtime, has) VALUES (?, ?, ?)',
+                             (path, mtime, _has_visible(folders)))
+
+    def folder_del(self, path):
+        """ Forget the content of path, that does not exist anymore """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM folders WHERE path = ?', (path,))
+            self._db.execute('DELETE FROM subfolders WHERE path = ?', (path,))
+
+    def subfolders_get(self, path, mtime):
+        """ True/False if path has (non hidden) subfolders, None if unknown """
+        with self._lock:
+            row = self._db.execute('SELECT mtime, has FROM subfolders '
+                                   'WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != mtime:
+            return None
+        return bool(row[1])
+
+    def subfolders_set(self, path, mtime, has):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO subfolders '
+                             '(path, mtime, has) VALUES (?, ?, ?)',
+                             (path, mtime, bool(has)))
+
+    def subfolders_guess(self, paths):
+        """ Last known subfolders flag of paths, even if outdated
+
+        Return a dict path -> bool, without unknown paths. No need to stat
+        the folders, this is good for a first guess.
+        """
+        guess = {}
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i+500]
+                query = 'SELECT path, has FROM subfolders WHERE path IN (%s)' \
+                        % ','.join('?' * len(chunk))
+                for path, has in self._db.execute(query, chunk):
+                    guess[path] = bool(has)
+        return guess
+
+
+    def image_get(self, path, mtime):
+        """ The IMAGE_COLUMNS row of path, or None if unknown or outdated """
+        with self._lock:
+            row = self._db.execute('SELECT %s FROM images WHERE path = ?' %
+                                   ', '.join(IMAGE_COLUMNS),
+                                   (path,)).fetchone()
+        if row is None or row[1] != mtime:
+            return None
+        return row
+
+    def images_set(self, rows):
+        """ Store many IMAGE_COLUMNS rows at once """
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO images (%s) '
+                                 'VALUES (%s)' % (', '.join(IMAGE_COLUMNS),
+                                 ', '.join('?' * len(IMAGE_COLUMNS))), rows)
+
+    def images_seen(self, paths):
+        """ Make the not yet known paths searchable by name
+
+        Their rows have only the path, with an UNKNOWN_MTIME that never
+        validate, the metadata columns are filled in when read.
+        """
+        for i in range(0, len(paths), 500):
+            with self._lock, self._db:
+                self._db.executemany('INSERT OR IGNORE INTO images '
+                                     '(path, mtime) VALUES (?, ?)',
+                                     [(p, UNKNOWN_MTIME)
+                                      for p in paths[i:i+500]])
+
+    def images_get(self, paths):
+        """ Return a dict path -> IMAGE_COLUMNS row, for the known paths only
+
+        Rows are not checked against the files, they can be outdated.
+        """
+        rows = {}
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i+500]
+                query = 'SELECT %s FROM images WHERE path IN (%s) ' \
+                        'AND mtime != ?' % (', '.join(IMAGE_COLUMNS),
+                                            ','.join('?' * len(chunk)))
+                chunk = chunk + [UNKNOWN_MTIME]
+                for row in self._db.execute(query, chunk):
+                    rows[row[0]] = row
+        return rows
+
+    def images_mtime(self, paths):
+        """ Return a dict path -> stored mtime, for the known paths only """
+        mtimes = {}
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i+500]
+                query = 'SELECT path, mtime FROM images WHERE path IN (%s)' \
+                        % ','.join('?' * len(chunk))
+                mtimes.update(self._db.execute(query, chunk))
+        return mtimes
+
+    def hashes_get(self, paths):
+        """ Return a dict path -> (mtime, dhash), for the known paths only """
+        hashes = {}
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i+500]
+                query = 'SELECT path, mtime, dhash FROM hashes ' \
+                        'WHERE path IN (%s)' % ','.join('?' * len(chunk))
+                for path, mtime, dhash in self._db.execute(query, chunk):
+                    hashes[path] = (mtime, dhash)
+        return hashes
+
+    def hashes_set(self, rows):
+        """ Store many (path, mtime, dhash) rows at once """
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO hashes '
+                                 '(path, mtime, dhash) VALUES (?, ?, ?)', rows)
+
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        """ Paths of the images matching text, sorted
+
+        Words are searched in the path, camera and lens. key:value terms
+        restrict the search: camera: make: model: lens: name: for the text
+        columns, date:2019 or date:2019-05-12 for the capture date,
+        width: height: iso: focal: fnumber: size: with a number, optionally
+        prefixed by <, >, <= or >= (ex: lens:85mm date:2019 width:>4000).
+        """
+        where, params, match = [], [], []
+        for term in text.split():
+            key, sep, value = term.partition(':')
+            key = key.lower()
+            if not sep or not value:
+                key, value = None, term
+            if key == 'date':
+                # exif dates are 'YYYY:MM:DD HH:MM:SS'
+                value = value.replace('-', ':')
+                if self._fts == 'trigram' and len(value) >= 3:
+                    self._search_word('date', value, where, params, match)
+                else:
+                    where.append('date >= ? AND date < ?')
+                    params += [value, value[:-1] + chr(ord(value[-1]) + 1)]
+            elif key in SEARCH_NUMBERS:
+                m = re.match(r'(<=|>=|<|>|=)?([0-9.]+)$', value)
+                if m is None:
+                    return []
+                where.append('%s %s ?' % (key, m.group(1) or '='))
+                params.append(float(m.group(2)))
+            else:
+                column = SEARCH_KEYS.get(key)
+                if column is None: # not a key, just a word with a colon
+                    column, value = None, term
+                self._search_word(column, value, where, params, match)
+
+        if not where and not match:
+            return []
+        # no ORDER BY, sorting all the matches of a broad search is the
+        # slowest part, the limited results are sorted here instead
+        query = 'SELECT path FROM images WHERE '
+        if match:
+            query += 'rowid IN (SELECT rowid FROM images_fts ' \
+                     'WHERE images_fts MATCH ?%s)' % \
+                     ('' if where else ' LIMIT %d' % limit)
+            params.insert(0, ' AND '.join(match))
+            if where:
+                query += ' AND '
+        query += ' AND '.join(where) + ' LIMIT %d' % limit
+        with self._lock:
+            paths = [row[0] for row in self._db.execute(query, params)]
+        paths.sort()
+        return paths
+
+    def _search_word(self, column, word, where, params, match):
+        # trigrams need at least 3 chars, the others can only match words
+        if self._fts is None or (self._fts == 'trigram' and len(word) < 3):
+            cols = [column] if column and column[0] != '{' else \
+                   (column or ' '.join(SEARCH_TEXT)).strip('{}').split()
+            where.append('(%s)' % ' OR '.join('%s LIKE ?' % c for c in cols))
+            params.extend(['%' + word + '%'] * len(cols))
+            return
+        phrase = '"%s"' % word.replace('"', '""')
+        if self._fts != 'trigram':
+            phrase += ' *'
+        match.append('%s: %s' % (column, phrase) if column else phrase)
+
+
+def _unpack(names):
+    return names.split(SEP) if names else []
+
+def _has_visible(folders):
+    return any(f[0] != '.' for f in folders)
+
+
+_instance = None
+
+def instance():
+    """ The shared Catalog, opened on first use """
+    global _instance
+    if _instance is None:
+        _instance = Catalog()
+    return _instance
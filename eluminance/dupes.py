@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Duplicate and near duplicate photos finder
+
+Every photo is reduced to a 64 bits difference hash (dHash): the image is
+scaled down to 9x8 gray pixels and every bit tells if a pixel is brighter
+than its left neighbour. Burst shots, re-exports and resized copies get
+hashes that differ only in a few bits (the Hamming distance).
+Hashes are computed from the thumbnails when available, and stored in the
+catalog.
+
+To find all the pairs within DISTANCE without comparing every photo with
+every other one, multi-index hashing is used: the hash is split in
+DISTANCE+2 blocks, two hashes within DISTANCE always have at least two
+identical blocks, so only the photos sharing a pair of blocks are compared.
+All of this is done with numpy, on the whole collection at once.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import itertools
+import threading
+try:
+    from queue import Queue, Empty
+except ImportError: # python 2
+    from Queue import Queue, Empty
+
+from efl import ecore
+
+import eluminance.catalog as catalog
+import eluminance.thumbnails as thumbnails
+from eluminance.scanner import walk_images
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+
+
+DISTANCE = 4      # max different bits in near duplicates
+HASH_BATCH = 256  # images hashed at once
+
+
+def available():
+    """ True if duplicates can be searched (numpy and PIL are installed) """
+    return np is not None
+
+def _load_small(path):
+    img = Image.open(path)
+    img.draft('L', (64, 64))  # let the jpeg decoder scale down for us
+    return img.convert('L').resize((9, 8), Image.BILINEAR)
+
+def dhash_files(files):
+    """ The signed 64 bits dHash of each image file, None for failures """
+    pixels = np.zeros((len(files), 8, 9), np.uint8)
+    ok = np.ones(len(files), bool)
+    for i, path in enumerate(files):
+        try:
+            pixels[i] = np.asarray(_load_small(path))
+        except Exception as e:
+            print("ERROR: Cannot hash '%s': %s" % (path, e))
+            ok[i] = False
+    bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+    hashes = np.packbits(bits.reshape(len(files), 64), axis=1)
+    hashes = hashes.view('>i8').ravel().astype(np.int64)
+    return [int(h) if good else None for h, good in zip(hashes, ok)]
+
+def _popcount(x):
+    if hasattr(np, 'bitwise_count'): # numpy >= 2.0
+        return np.bitwise_count(x)
+    table = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+    return table[x.view(np.uint8)].reshape(-1, 8).sum(1)
+
+def near_pairs(hashes, distance=DISTANCE):
+    """ All the (i, j) pairs of hashes (uint64 array) within distance
+
+    Return two index arrays. Hashes must be unique, or all the identical
+    ones would be compared with each other.
+    """
+    n = len(hashes)
+    found_a, found_b = [np.zeros(0, np.intp)], [np.zeros(0, np.intp)]
+    if n < 2:
+        return found_a[0], found_b[0]
+    m = distance + 2
+    widths = [64 // m + (1 if i < 64 % m else 0) for i in range(m)]
+    shifts = [sum(widths[:i]) for i in range(m)]
+    blocks = [(hashes >> np.uint64(s)) & np.uint64((1 << w) - 1)
+              for s, w in zip(shifts, widths)]
+    # keys and positions are packed in a single uint64, sorting that is
+    # much faster than an argsort of the keys
+    pos_bits = max(1, (n - 1).bit_length())
+    positions = np.arange(n, dtype=np.uint64)
+    for i, j in itertools.combinations(range(m), 2):
+        key = (blocks[i] << np.uint64(widths[j])) | blocks[j]
+        packed = np.sort((key << np.uint64(pos_bits)) | positions)
+        keys = packed >> np.uint64(pos_bits)
+        order = (packed & np.uint64((1 << pos_bits) - 1)).astype(np.intp)
+        # compare each photo with the following ones with the same key
+        idx = np.flatnonzero(keys[1:] == keys[:-1])
+        k = 1
+        while len(idx):
+            a, b = order[idx], order[idx + k]
+            close = _popcount(hashes[a] ^ hashes[b]) <= distance
+            found_a.append(a[close])
+            found_b.append(b[close])
+            k += 1
+            idx = idx[idx + k < n]
+            idx = idx[keys[idx] == keys[idx + k]]
+    return np.concatenate(found_a), np.concatenate(found_b)
+
+def find_groups(hashes, distance=DISTANCE):
+    """ Group the hashes (signed ints) that are within distance
+
+    Return a list of groups, every group is a list of indexes of hashes,
+    photos without any duplicate are not reported.
+    """
+    hashes = np.asarray(hashes, np.int64).view(np.uint64)
+    uniq, inverse = np.unique(hashes, return_inverse=True)
+    a, b = near_pairs(uniq, distance)
+
+    # connected components: propagate the min label along the pairs
+    labels = np.arange(len(uniq))
+    while len(a):
+        low = np.minimum(labels[a], labels[b])
+        new = labels.copy()
+        np.minimum.at(new, a, low)
+        np.minimum.at(new, b, low)
+        new = new[new]  # pointer jumping
+        if np.array_equal(new, labels):
+            break
+        labels = new
+
+    # only the photos with at least one duplicate
+    labels = labels[inverse.ravel()]
+    dupes = np.flatnonzero(np.bincount(labels)[labels] > 1)
+    order = dupes[np.argsort(labels[dupes], kind='stable')]
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    groups = [g.tolist() for g in np.split(order, bounds)] if len(order) else []
+    groups.sort(key=lambda g: g[0])
+    return groups
+
+
+def collection_hashes(paths, cancelled=None):
+    """ Return the hash of every path (None if it cannot be hashed)
+
+    Valid hashes are taken from the catalog, the others are computed (from
+    the thumbnails if available) and stored.
+    """
+    cat = catalog.instance()
+    known = cat.hashes_get(paths)
+    hashes = [None] * len(paths)
+    todo = []
+    for i, path in enumerate(paths):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        stored = known.get(path)
+        if stored is not None and stored[0] == mtime:
+            hashes[i] = stored[1]
+        else:
+            todo.append((i, path, mtime))
+
+    for start in range(0, len(todo), HASH_BATCH):
+        if cancelled is not None and cancelled.is_set():
+            break
+        batch = todo[start:start+HASH_BATCH]
+        files = [thumbnails.thumb_lookup(path) or path for _, path, _ in batch]
+        rows = []
+        for (i, path, mtime), h in zip(batch, dhash_files(files)):
+            if h is not None:
+                hashes[i] = h
+                rows.append((path, mtime, h))
+        cat.hashes_set(rows)
+    return hashes
+
+
+class DupesFinder(object):
+    """ Search the duplicates of all the photos below root
+
+    Everything is done in a worker thread, done_cb(groups) is then called
+    in the main loop with the list of groups, each one a list of paths.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, root, done_cb, distance=DISTANCE):
+        self.root = root
+        self.distance = distance
+        self._done_cb = done_cb
+        self._cancelled = threading.Event()
+        self._results = Queue()
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+        self._timer = ecore.Timer(self.POLL_INTERVAL, self._poll_cb)
+
+    def cancel(self):
+        self._cancelled.set()
+        if self._timer is not None:
+            self._timer.delete()
+            self._timer = None
+
+    # worker thread
+    def _worker(self):
+        # a result is always given, or the main loop would wait forever
+        try:
+            groups = self._search()
+        except Exception as e:
+            print("ERROR: Cannot search duplicates in '%s': %s" %
+                  (self.root, e))
+            groups = []
+        self._results.put(groups)
+
+    def _search(self):
+        paths = []
+        for folder, names in walk_images(self.root, self._cancelled):
+            paths.extend(os.path.join(folder, n) for n in names)
+        hashes = collection_hashes(paths, self._cancelled)
+        if self._cancelled.is_set():
+            return []
+        valid = [i for i, h in enumerate(hashes) if h is not None]
+        groups = find_groups([hashes[i] for i in valid], self.distance)
+        return [[paths[valid[i]] for i in g] for g in groups]
+
+    # main loop
+    def _poll_cb(self):
+        try:
+            groups = self._results.get_nowait()
+        except Empty:
+            return ecore.ECORE_CALLBACK_RENEW
+        self._timer = None
+        self._done_cb(groups)
+        return ecore.ECORE_CALLBACK_CANCEL
@@ -20,23 +20,41 @@
 
 from __future__ import absolute_import, print_function
 
+import time
+IMPORT_START = time.time()
+
 import os
 import sys
+import argparse
 import pickle
 import gettext
-from xdg.BaseDirectory import xdg_config_home
+try:
+    from importlib.util import find_spec
+except ImportError: # python 2
+    from pkgutil import find_loader as find_spec
+from xdg.BaseDirectory import xdg_config_home, xdg_cache_home
 
 from efl import edje
+from efl import ecore
+from efl import evas
 from efl import elementary as elm
 from efl.evas import EXPAND_BOTH, EXPAND_HORIZ, EXPAND_VERT, \
                      FILL_BOTH, FILL_HORIZ, FILL_VERT
 
 import eluminance.utils as utils
+import eluminance.files as files
+import eluminance.metadata as metadata
+import eluminance.catalog as catalog
+import eluminance.perf as perf
+import eluminance.archives as archives
+from eluminance.model import FolderModel, Photo, SORT_MODES
+from eluminance.cache import LRUCache, MemoryBudget, memory_pressure
+from eluminance.scanner import FolderScanner, SubfolderProber, scan_folder, \
+                               MetadataReader
+from eluminance.watcher import FolderWatcher
 
 __version__ = '0.9'
 
-IMG_EXTS = ('.jpg','.jpeg','.png','.gif','.tiff','.bmp')
-
 script_path = os.path.dirname(os.path.abspath(__file__))
 # Fix for lib64 taken from commit https://github.com/DaveMDS/egitu/commit/c92699b5e66f5d2a0ee02d5f4a5fa60afb3b21fb
 install_prefix = script_path[0:script_path.find('/python')]
@@ -57,6 +75,16 @@ class Options(object):
         self.sshow_transition = 'fade_fast'
         self.sshow_loop = True
         self.favorites = []
+        self.thumb_workers = 0 # 0 means one per cpu core
+        self.prefetch_next = 2
+        self.prefetch_prev = 1
+        self.prefetch_cache_mb = 384
+        self.memory_budget_mb = 1024 # all the decoded photos
+        self.tiled_threshold_mp = 50 # bigger images are shown tiled
+        self.tiles_cache_mb = 2048
+        self.animation_cache_mb = 64 # bigger animations are decoded per frame
+        self.sort_mode = 'name' # one of model.SORT_MODES
+        self.group_by_day = False
 
     def load(self):
         try:
@@ -98,16 +126,85 @@ class StdButton(elm.Button):
         self.content = utils.SafeIcon(self, name, size_hint_min=(18,18))
 
 
+def _is_huge(path):
+    """ True if path is too big to be decoded at once, and can be tiled """
+    if app.pyramids is None or archives.split(path) is not None:
+        return False
+    try:
+        meta = metadata.get(path)
+    except OSError: # gone
+        return False
+    if not meta.width or not meta.height:
+        return False
+    return meta.width * meta.height > options.tiled_threshold_mp * 1000000
+
+def _preview_usable(preview_size, size):
+    """ True if an embedded preview can stand in for the full image
+
+    Camera thumbnails are often 4:3 with black bands, whatever the sensor.
+    """
+    pw, ph = preview_size
+    w, h = size
+    if pw >= w or ph >= h:
+        return False
+    return abs(float(pw) / ph - float(w) / h) < 0.02 * float(w) / h
+
+def _file_load(img, path):
+    """ img.file_set(path), the archive members are decoded from memory """
+    if archives.split(path) is None:
+        img.file_set(path)
+        return
+    try:
+        data = archives.read(path)
+    except (IOError, OSError) as e:
+        print("ERROR: Cannot read '%s': %s" % (path, e))
+        return
+    img.memfile_set(data, len(data), os.path.splitext(path)[1][1:])
+
+def _dupes_available():
+    """ dupes.available(), without importing numpy and PIL (slow) """
+    return find_spec('numpy') is not None and find_spec('PIL') is not None
+
+def _fit_prescale(path, viewport):
+    """ The decode size of path just big enough to fit in viewport
+
+    Return (prescale, original size), prescale is 0 when the image must be
+    decoded at full size. The jpeg loader turn the prescale into a DCT
+    scaled decode, so most of the work is skipped, not only the memory.
+    """
+    try:
+        meta = metadata.get(path)
+    except OSError: # gone
+        return 0, (0, 0)
+    size = meta.width or 0, meta.height or 0
+    vw, vh = viewport
+    if vw <= 0 or vh <= 0:
+        vw, vh = app.win.size
+    if size[0] <= 0 or size[1] <= 0 or vw <= 0 or vh <= 0:
+        return 0, size
+    scale = min(float(vw) / size[0], float(vh) / size[1])
+    if scale >= 1.0:
+        return 0, size
+    return int(max(size) * scale + 0.5), size
+
+
 class TreeView(elm.Table):
-    def __init__(self, parent, select_cb):
+    def __init__(self, parent, select_cb, search_cb, watcher):
         self._select_cb = select_cb
+        self._search_cb = search_cb
+        self._watcher = watcher
+        self._root = None
+        self._items = {}    # path -> GenlistItem
+        self._children = {} # path -> list of populated children paths
+        self._leaves = set() # paths of the items without the expander
+        self._prober = SubfolderProber(self._probed_cb)
 
         elm.Table.__init__(self, parent, size_hint_expand=EXPAND_BOTH,
                            size_hint_fill=FILL_BOTH)
 
         bg = elm.Background(self, size_hint_expand=EXPAND_BOTH, 
                         size_hint_fill=FILL_BOTH)
-        self.pack(bg, 0, 0, 1, 2)
+        self.pack(bg, 0, 0, 1, 3)
         bg.show()
 
         self.sc = elm.SegmentControl(self)
@@ -122,7 +219,18 @@ class TreeView(elm.Table):
                         size_hint_expand=EXPAND_HORIZ)
         self.pack(pad, 0, 0, 1, 1)
         pad.show()
-        
+
+        self.search = elm.Entry(self, single_line=True, scrollable=True,
+                                size_hint_expand=EXPAND_HORIZ,
+                                size_hint_fill=FILL_HORIZ)
+        self.search.part_text_set('guide', _('Search (ex: IMG_48 lens:85mm date:2019)'))
+        self.search.callback_activated_add(self._search_activated_cb)
+        pad = elm.Frame(self, style='pad_small', content=self.search,
+                        size_hint_expand=EXPAND_HORIZ,
+                        size_hint_fill=FILL_HORIZ)
+        self.pack(pad, 0, 1, 1, 1)
+        pad.show()
+
         self.itc = elm.GenlistItemClass('one_icon',
                                         text_get_func=self._gl_text_get,
                                         content_get_func=self._gl_content_get)
@@ -136,16 +244,29 @@ class TreeView(elm.Table):
         self.li.callback_clicked_double_add(self._item_expand_request_cb)
         self.li.callback_clicked_right_add(self._item_clicked_right_cb)
         self.li.callback_longpressed_add(self._item_clicked_right_cb)
-        self.pack(self.li, 0, 1, 1, 1)
+        self.pack(self.li, 0, 2, 1, 1)
         self.li.show()
 
+    def _search_activated_cb(self, en):
+        text = en.markup_to_utf8(en.text).strip()
+        if text:
+            it = self.li.selected_item
+            if it is not None: # so that the folder can be selected again
+                it.selected = False
+            self._search_cb(text)
+
     def _gl_text_get(self, gl, part, item_data):
         if item_data is None: return _('No items to show')
         return os.path.basename(item_data)
 
     def _gl_content_get(self, gl, part, item_data):
         if item_data is not None:
-            icon = 'starred' if item_data in options.favorites else 'folder'
+            if item_data in options.favorites:
+                icon = 'starred'
+            elif archives.is_archive(item_data):
+                icon = 'package-x-generic'
+            else:
+                icon = 'folder'
             return utils.SafeIcon(gl, icon, resizable=(False,False))
 
     def _item_selected_cb(self, gl, item):
@@ -161,8 +282,19 @@ class TreeView(elm.Table):
         item.expanded = False
 
     def _item_contracted_cb(self, gl, item):
+        self._forget_children(item.data)
         item.subitems_clear()
 
+    def _forget_children(self, path):
+        children = self._children.pop(path, None)
+        if children is None:
+            return
+        self._watcher.unwatch(path)
+        for child in children:
+            self._items.pop(child, None)
+            self._leaves.discard(child)
+            self._forget_children(child)
+
     def _item_clicked_right_cb(self, gl, item):
         if item.disabled: return
         item.selected = True
@@ -174,6 +306,11 @@ class TreeView(elm.Table):
         pop.callback_dismissed_add(self._popup_dismissed_cb)
         pop.item_append(_('Set as root'), None, 
                         self._popup_set_root_cb, item.data)
+        pop.item_append(_('Show all photos below'), None,
+                        self._popup_recursive_cb, item.data)
+        if _dupes_available() and archives.split(item.data) is None:
+            pop.item_append(_('Find duplicates below'), None,
+                            self._popup_dupes_cb, item.data)
         if item.data in options.favorites:
             label = _('Remove from favorites')
             icon = utils.SafeIcon(pop, 'bookmark-remove')
@@ -190,6 +327,14 @@ class TreeView(elm.Table):
         self.set_root(path)
         pop.dismiss()
     
+    def _popup_recursive_cb(self, pop, item, path):
+        self._select_cb(path, recursive=True)
+        pop.dismiss()
+
+    def _popup_dupes_cb(self, pop, item, path):
+        app.find_duplicates(path)
+        pop.dismiss()
+
     def _popup_toggle_fav_cb(self, pop, item, path):
         if path in options.favorites:
             options.favorites.remove(path)
@@ -215,49 +360,137 @@ class TreeView(elm.Table):
                 self.sc.item_selected.selected = False
 
         self.li.clear()
+        for folder in self._children:
+            self._watcher.unwatch(folder)
+        self._prober.clear()
+        self._items = {}
+        self._children = {}
+        self._leaves = set()
+        self._root = path
         self.populate(path)
     
     def populate(self, path, parent=None):
-        it = None
         if path == 'favs':
-            for path in utils.natural_sort(options.favorites):
-                it = self.li.item_append(self.itc, path, parent,
-                                         flags=elm.ELM_GENLIST_ITEM_TREE)
+            children = files.natural_sort(options.favorites)
+        else:
+            if archives.split(path) is None:
+                self._watcher.watch(path)
+            try:
+                folders = scan_folder(path)[1]
+            except OSError as e:
+                print("ERROR: Cannot read folder '%s': %s" % (path, e))
+                folders = []
+            children = [os.path.join(path, f) for f in folders if f[0] != '.']
+        self._children[path] = children
+
+        # the expanders are drawn from the last known state, then fixed
+        # by the prober if the subfolders have changed in the meantime
+        guess = catalog.instance().subfolders_guess(children)
+        for child in children:
+            if guess.get(child, True):
+                flags = elm.ELM_GENLIST_ITEM_TREE
+            else:
+                flags = elm.ELM_GENLIST_ITEM_NONE
+                self._leaves.add(child)
+            self._items[child] = self.li.item_append(self.itc, child, parent,
+                                                     flags=flags)
+        if children:
+            self._prober.probe(children)
         else:
-            for f in utils.natural_sort(os.listdir(path)):
-                if f[0] == '.': continue
-                fullpath = os.path.join(path, f)
-                if os.path.isdir(fullpath):
-                    it = self.li.item_append(self.itc, fullpath, parent,
-                                             flags=elm.ELM_GENLIST_ITEM_TREE)
-        if it is None:
             it = self.li.item_append(self.itc, None, parent)
             it.disabled = True
 
+    def _probed_cb(self, path, has_subfolders):
+        it = self._items.get(path)
+        if it is None or has_subfolders != (path in self._leaves) or \
+                it.selected or it.expanded:
+            return
+        # the item type cannot be changed, replace the item
+        if has_subfolders:
+            flags = elm.ELM_GENLIST_ITEM_TREE
+            self._leaves.discard(path)
+        else:
+            flags = elm.ELM_GENLIST_ITEM_NONE
+            self._leaves.add(path)
+        self._items[path] = self.li.item_insert_before(self.itc, path, it,
+                                                       flags=flags)
+        it.delete()
+
+    def _repopulate(self, path):
+        if path == self._root:
+            self.set_root(path, update_sc=False)
+        else:
+            parent = self._items[path]
+            self._forget_children(path)
+            parent.subitems_clear()
+            self.populate(path, parent)
+
+    def folder_changed(self, folder, names, renames):
+        """ Add/remove the changed subfolders of a populated folder """
+        children = self._children.get(folder)
+        if children is None or folder == 'favs':
+            return
+        if names is None or not children: # unknown changes or placeholder
+            self._repopulate(folder)
+            return
+        parent = self._items.get(folder)
+        for name in names:
+            if name[0] == '.': continue
+            path = os.path.join(folder, name)
+            is_dir = os.path.isdir(path) or \
+                     (archives.is_archive(name) and os.path.isfile(path))
+            if is_dir and path not in self._items:
+                pos = files.natural_bisect(children, name, os.path.basename)
+                if pos < len(children):
+                    it = self.li.item_insert_before(self.itc, path,
+                                     self._items[children[pos]],
+                                     flags=elm.ELM_GENLIST_ITEM_TREE)
+                else:
+                    it = self.li.item_append(self.itc, path, parent,
+                                     flags=elm.ELM_GENLIST_ITEM_TREE)
+                self._items[path] = it
+                children.insert(pos, path)
+                self._prober.probe([path])
+            elif not is_dir and path in self._items:
+                self._items.pop(path).delete()
+                self._leaves.discard(path)
+                self._forget_children(path)
+                children.remove(path)
+                catalog.instance().folder_del(path) # deleted or renamed
+        if not children:
+            self._repopulate(folder)
+
     def expand_to_folder(self, path):
-        if os.path.isfile(path):
+        if os.path.isfile(path) and not archives.is_archive(path):
             path = os.path.dirname(path)
-        it = self.li.first_item
-        while it:
-            if it.data == path:
-                it.expanded = True
+        # all the ancestors of path, from the top most one
+        ancestors = [path]
+        while os.path.dirname(ancestors[-1]) != ancestors[-1]:
+            ancestors.append(os.path.dirname(ancestors[-1]))
+        # expanding an item populate its children, so that the next level
+        # can be found in the index
+        for folder in reversed(ancestors):
+            it = self._items.get(folder)
+            if it is None:
+                continue
+            it.expanded = True
+            if folder == path:
                 it.selected = True
                 it.show()
                 return
-            if path.startswith(it.data + os.path.sep):
-                it.expanded = True
-                it = it.subitems_get()[0]
-            else:
-                it = it.next
 
 
 class PhotoGrid(elm.Gengrid):
-    def __init__(self, parent, select_cb):
+    def __init__(self, parent, model, select_cb):
+        self._model = model
         self._select_cb = select_cb
+        self._items = {}  # path -> GengridItem, the data is the model Photo
         self.itc = elm.GengridItemClass('default',
                                         text_get_func=self._gg_text_get,
                                         content_get_func=self._gg_content_get)
-        elm.Gengrid.__init__(self, parent,
+        self.group_itc = elm.GengridItemClass('group_index',
+                                        text_get_func=self._gg_group_text_get)
+        elm.Gengrid.__init__(self, parent, group_item_size=(128, 32),
                              item_size=(128, 128), align=(0.5, 0.0),
                              select_mode=elm.ELM_OBJECT_SELECT_MODE_ALWAYS)
         self.callback_selected_add(self._item_selected_cb)
@@ -266,71 +499,139 @@ class PhotoGrid(elm.Gengrid):
                                      self._drag_item_data_get)
     
     def _drag_item_get(self, obj, x, y):
-        return self.at_xy_item_get(x, y)
+        item = self.at_xy_item_get(x, y)
+        if item is not None and isinstance(item.data, Photo):
+            return item # the group headers cannot be dragged
 
     def _drag_item_data_get(self, obj, item, info):
+        if not isinstance(item.data, Photo):
+            return False
+        if archives.split(item.data.path) is not None:
+            return False # no file to give to the other applications
         info.format = elm.ELM_SEL_FORMAT_TARGETS
         info.createicon = self._drag_create_icon
         info.createdata = item
         info.dragdone = self._drag_done
         info.donecbdata = item
-        info.data = 'file://' + item.data
+        info.data = 'file://' + item.data.path
         return True
 
     def _drag_create_icon(self, win, xoff, yoff, item):
         item.cursor = 'fleur'
-        ic = elm.Photo(win, file=item.data, aspect_fixed=True,
+        ic = elm.Photo(win, file=item.data.path, aspect_fixed=True,
                        fill_inside=False, size=100)
+        app.budget.add(('drag', item.data.path), 100 * 100 * 4)
         mx, my = self.evas.pointer_canvas_xy
         return (ic, mx - 60, my - 60)
 
     def _drag_done(self, obj, accepted, item):
         item.cursor = None
+        app.budget.remove(('drag', item.data.path))
 
-    def _gg_content_get(self, gg, part, item_data):
+    def _gg_content_get(self, gg, part, photo):
         if part == 'elm.swallow.icon':
-            return elm.Thumb(gg, style='noframe', aspect=elm.ETHUMB_THUMB_CROP,
-                             file=item_data)
-
-    def _gg_text_get(self, gg, part, item_data):
-        return os.path.basename(item_data)
+            path = photo.path
+            if app.thumbs is None: # no PIL, fallback to ethumb
+                return elm.Thumb(gg, style='noframe',
+                                 aspect=elm.ETHUMB_THUMB_CROP, file=path)
+            img = elm.Image(gg, fill_outside=True, preload_disabled=False)
+            thumb = app.thumbs.request(path, self._thumb_ready_cb, img)
+            if thumb:
+                img.file = thumb
+            elif thumb is None: # not ready, forget it if scrolled away
+                img.on_del_add(lambda o: app.thumbs.cancel(
+                                   path, self._thumb_ready_cb, img))
+            return img
+
+    def _thumb_ready_cb(self, path, thumb, img):
+        if thumb and not img.is_deleted():
+            img.file = thumb
+
+    def _gg_text_get(self, gg, part, photo):
+        return photo.name
+
+    def _gg_group_text_get(self, gg, part, item_data):
+        return item_data
 
     def _item_selected_cb(self, gg, item):
-        self._select_cb(item.data, item.index - 1)
+        self._select_cb(item.data.path)
+
+    def photos_add(self, photos):
+        """ Append the model photos """
+        for photo in photos:
+            self._items[photo.path] = self.item_append(self.itc, photo)
+
+    def group_add(self, title):
+        """ Add an header item, the photos added after it belong to it """
+        item = self.item_append(self.group_itc, title)
+        item.select_mode = elm.ELM_OBJECT_SELECT_MODE_NONE
+
+    def photos_set(self, photos, day_func=None):
+        """ Show only photos, with an header for every day if day_func """
+        self.clear()
+        day = False
+        for photo in photos:
+            if day_func is not None and day_func(photo) != day:
+                day = day_func(photo)
+                self.group_add(day or _('Unknown date'))
+            self._items[photo.path] = self.item_append(self.itc, photo)
+
+    def photo_insert(self, photo, pos):
+        """ Add a photo just inserted in the model at pos """
+        if pos + 1 < len(self._model):
+            before = self._items[self._model[pos + 1].path]
+            item = self.item_insert_before(self.itc, photo, before)
+        else:
+            item = self.item_append(self.itc, photo)
+        self._items[photo.path] = item
 
-    def photo_add(self, path):
-        self.item_append(self.itc, path)
+    def photo_remove(self, path):
+        self._items.pop(path).delete()
+
+    def photo_update(self, path):
+        """ Refresh the thumbnail of a modified photo """
+        self._items[path].update()
+
+    def clear(self):
+        self._items = {}
+        elm.Gengrid.clear(self)
 
     def file_select(self, path):
-        if self.selected_item and self.selected_item.data == path:
+        item = self.selected_item
+        if item is not None and item.data.path == path:
             return
-        it = self.first_item
-        while it:
-            if it.data == path:
-                it.selected = True
-                it.show() # XXX this is quite annoying if you are browsing the grid
-                return
-            it = it.next
+        it = self._items.get(path)
+        if it is not None:
+            it.selected = True
+            it.show() # XXX this is quite annoying if you are browsing the grid
 
 
 class ScrollablePhoto(elm.Scroller):
     ZOOMS = [5, 7, 10, 15, 20, 30, 50, 75, 100, 150, 200, 300,
              500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000]
-    def __init__(self, parent, zoom_changed_cb):
+    def __init__(self, parent, zoom_changed_cb, **kargs):
         self._zoom_changed_cb = zoom_changed_cb
         self._zoom_mode = None # 'fill' or 'fit' on resize
+        self._file = None
+        self._load_scale = 1.0 # decoded size / original size
+        self._pending = None # hidden image decoding while the preview is shown
+        self._animate = False # play the animation, if the photo is animated
+        self._frames = 1 # decoded frames kept by evas
+        self._player = None # animation.FramePlayer, for the long animations
         self.image_size = 0, 0 # original image pixel size
 
         elm.Scroller.__init__(self, parent, style="trans",
                 policy=(elm.ELM_SCROLLER_POLICY_OFF, elm.ELM_SCROLLER_POLICY_OFF),
                 movement_block=elm.ELM_SCROLLER_MOVEMENT_BLOCK_VERTICAL |
-                               elm.ELM_SCROLLER_MOVEMENT_BLOCK_HORIZONTAL)
+                               elm.ELM_SCROLLER_MOVEMENT_BLOCK_HORIZONTAL,
+                **kargs)
         self.on_mouse_wheel_add(self._on_mouse_wheel)
         self.on_mouse_down_add(self._on_mouse_down)
         self.on_mouse_up_add(self._on_mouse_up)
         self.on_resize_add(self._on_resize)
+        self.on_del_add(self._on_del_budget)
 
-        self.img = elm.Image(self, preload_disabled=False)
+        self.img = self._image_add()
         self.img.show()
 
         # table help to keep the image centered in the scroller
@@ -339,12 +640,127 @@ class ScrollablePhoto(elm.Scroller):
         tb.pack(self.img, 0, 0, 1, 1)
         self.content = tb
 
-    def file_set(self, file):
-        self.img.file_set(file)
-        self.image_size = self.img.object_size
-        if self.img.animated_available:
-            self.img.animated = True
-            self.img.animated_play = True
+    def _image_add(self):
+        return elm.Image(self, preload_disabled=False)
+
+    @perf.timed('photo.file_set')
+    def file_set(self, file, viewport=(0, 0), progressive=True):
+        """ Decode file at the size needed to fit it in viewport
+
+        The full decode is done later, only if zoomed past that size.
+        If progressive the embedded preview (if any) is shown at once, and
+        swapped with the real image when its decode is done.
+        """
+        self._file = file
+        self._pending_cancel()
+        self._animation_stop()
+        self._frames = 1
+        prescale, size = _fit_prescale(file, viewport)
+        # the hidden decode of the members would not be shared (memfile)
+        if archives.split(file) is not None:
+            progressive = False
+        preview = metadata.preview(file) if progressive and size[0] else None
+        if preview is not None and _preview_usable(preview[1:], size):
+            data = preview[0]
+            self.img.memfile_set(data, len(data), 'jpg')
+            # decode in an hidden image, the photo will then get the pixels
+            # from the evas cache, as the load options are the same
+            self._pending = evas.Image(self.evas)
+            if prescale:
+                self._pending.load_size = prescale, prescale
+            self._pending.file = file
+            self._pending.on_image_preloaded_add(self._pending_cb, prescale)
+            self._pending.preload()
+            perf.count('photo.preview')
+        else:
+            self.img.prescale = prescale
+            _file_load(self.img, file)
+        if prescale:
+            self._load_scale = float(prescale) / max(size)
+            self.image_size = size
+            perf.count('photo.reduced_decode')
+        elif self._pending is not None:
+            # the preview is shown, the full size decode is on its way
+            self._load_scale = 1.0
+            self.image_size = size
+        else:
+            self._load_scale = 1.0
+            self.image_size = self.img.object_size
+        self._animation_update()
+        self._budget_update()
+
+    def _pending_cb(self, obj, prescale):
+        self._pending_cancel()
+        self.img.prescale = prescale
+        _file_load(self.img, self._file)
+        self._animation_update()
+        self._budget_update()
+
+    def animation_set(self, play):
+        """ Play or stop the animation, if the photo is animated
+
+        Only the photos on screen should play, the others would keep
+        decoding frames for nothing.
+        """
+        self._animate = play
+        self._animation_update()
+        self._budget_update()
+
+    def _animation_update(self):
+        img = self.img
+        if not self._animate or self._pending is not None:
+            if self._player is not None:
+                self._player.stop() # the image keeps the frame shown
+            else:
+                self._animation_stop()
+            return
+        if self._player is not None:
+            self._player.play()
+            return
+        if img.animated_play:
+            return # already playing
+        if not img.animated_available:
+            return
+        import eluminance.animation as animation
+        w, h = img.object_size
+        count = img.object.animated_frame_count
+        max_bytes = options.animation_cache_mb * 1024 * 1024
+        if animation.frames_size(w, h, count) <= max_bytes:
+            img.animated = True
+            img.animated_play = True
+            self._frames = count
+        elif animation.available():
+            # too many frames to keep them all, decode one at a time
+            try:
+                self._player = animation.FramePlayer(self._file, img)
+                self._player.play()
+            except Exception as e:
+                print("ERROR: Cannot play '%s': %s" % (self._file, e))
+                self._player = None
+            perf.count('photo.frame_player')
+
+    def _animation_stop(self):
+        if self._player is not None:
+            self._player.close()
+            self._player = None
+        elif self.img.animated_play:
+            self.img.animated_play = False
+            self.img.animated = False
+
+    def _pending_cancel(self):
+        if self._pending is not None:
+            self._pending.delete()
+            self._pending = None
+
+    def _budget_update(self):
+        # visible photos are only accounted, to leave less room to the others
+        w, h = self.img.object_size
+        app.budget.add(('photo', id(self)), w * h * 4 * self._frames)
+
+    def _on_del_budget(self, obj):
+        app.budget.remove(('photo', id(self)))
+        self._pending_cancel()
+        self._animation_stop()
 
     def zoom_set(self, val):
         self._zoom_mode = None
@@ -371,6 +787,16 @@ class ScrollablePhoto(elm.Scroller):
     @zoom.setter
     def zoom(self, val):
         z = utils.clamp(self.ZOOMS[0], val, self.ZOOMS[-1]) / 100.0
+        if self._load_scale < 1.0 and z > self._load_scale * 1.01:
+            # zoomed past the reduced decode, time for the full one
+            self._pending_cancel()
+            self._animation_stop()
+            self._load_scale = 1.0
+            self.img.prescale = 0
+            with perf.timer('photo.full_decode'):
+                _file_load(self.img, self._file)
+            self._animation_update()
+            self._budget_update()
         w, h = self.image_size[0] * z, self.image_size[1] * z
         self.img.size_hint_min = w, h
         self.img.size_hint_max = w, h
@@ -426,6 +852,133 @@ class ScrollablePhoto(elm.Scroller):
                 self.zoom_centered(z * 100)
 
 
+class TiledPhoto(ScrollablePhoto):
+    """ ScrollablePhoto for huge images, only the visible tiles are loaded
+
+    The image is shown from its tiles pyramid (see tiles.py), built in the
+    background on the first view. Only the tiles in the visible region are
+    loaded, from the level that match the zoom, over a small preview of the
+    whole image, so memory stay flat whatever the image size.
+    """
+    MARGIN = 1 # tiles kept loaded around the visible region
+
+    def __init__(self, parent, zoom_changed_cb, **kargs):
+        import eluminance.tiles as tiles
+        self._tile_path = tiles.tile_path
+        self._path = None
+        self._info = None
+        self._preview = None
+        self._tiles = {} # (level, row, col) -> FilledImage
+        self._update_job = None
+        ScrollablePhoto.__init__(self, parent, zoom_changed_cb, **kargs)
+        self.img.on_resize_add(self._tiles_update_queue)
+        self.on_resize_add(self._tiles_update_queue)
+        self.callback_scroll_add(self._tiles_update_queue)
+        self.on_del_add(self._on_del)
+
+    def _image_add(self):
+        # the grid use image pixels as virtual units, and scale the tiles
+        box = elm.Table(self)
+        self._grid = elm.Grid(box, size_hint_expand=EXPAND_BOTH,
+                              size_hint_fill=FILL_BOTH)
+        box.pack(self._grid, 0, 0, 1, 1)
+        self._grid.show()
+        return box
+
+    @perf.timed('photo.file_set')
+    def file_set(self, path, viewport=(0, 0), progressive=True):
+        # the pyramid preview is shown at once anyway
+        meta = metadata.get(path)
+        self._path = path
+        self.image_size = meta.width, meta.height
+        self._grid.size = meta.width, meta.height
+        info = app.pyramids.request(path, self._pyramid_ready_cb)
+        if info is not None:
+            self._pyramid_set(info)
+
+    def _pyramid_ready_cb(self, path, info):
+        if info is not None:
+            self._pyramid_set(info)
+
+    def _pyramid_set(self, info):
+        self._info = info
+        self.image_size = info['width'], info['height']
+        self._grid.size = self.image_size
+        self._preview = evas.FilledImage(self.evas,
+                            file=os.path.join(info['dir'], 'preview.jpg'))
+        self._preview.preload()
+        self._grid.pack(self._preview, 0, 0, info['width'], info['height'])
+        self._preview.show()
+        self._tiles_update_queue()
+
+    def _on_del(self, obj):
+        if self._update_job is not None:
+            self._update_job.delete()
+            self._update_job = None
+        if self._info is None:
+            app.pyramids.cancel(self._path, self._pyramid_ready_cb)
+
+    def animation_set(self, play):
+        pass # huge photos are never animated
+
+    def _animation_update(self):
+        pass
+
+    def _animation_stop(self):
+        pass
+
+    def _budget_update(self):
+        pass # only the visible tiles are loaded, whatever the photo size
+
+    def _tiles_update_queue(self, *args):
+        # scroll, resize and zoom come in bursts, update once
+        if self._update_job is None and self._info is not None:
+            self._update_job = ecore.Job(self._tiles_update)
+
+    def _tiles_update(self):
+        self._update_job = None
+        info = self._info
+        gx, gy, gw, gh = self._grid.geometry
+        sx, sy, sw, sh = self.geometry
+        x1, y1 = max(gx, sx), max(gy, sy)
+        x2, y2 = min(gx + gw, sx + sw), min(gy + gh, sy + sh)
+        if x2 <= x1 or y2 <= y1:
+            return
+
+        # the smallest level with at least one pixel per screen pixel
+        W, H = info['width'], info['height']
+        scale = float(W) / gw # image pixels per screen pixel
+        level = 0
+        while level + 1 < info['levels'] and 2 ** (level + 1) <= scale:
+            level += 1
+        tile = info['tile']
+        size = tile << level # tile size in image pixels
+        cols = (-(-W >> level) + tile - 1) // tile
+        rows = (-(-H >> level) + tile - 1) // tile
+        c1 = max(0, int((x1 - gx) * scale) // size - self.MARGIN)
+        c2 = min(cols - 1, int((x2 - gx) * scale) // size + self.MARGIN)
+        r1 = max(0, int((y1 - gy) * scale) // size - self.MARGIN)
+        r2 = min(rows - 1, int((y2 - gy) * scale) // size + self.MARGIN)
+
+        needed = set()
+        for row in range(r1, r2 + 1):
+            for col in range(c1, c2 + 1):
+                key = (level, row, col)
+                needed.add(key)
+                if key in self._tiles:
+                    continue
+                x, y = col * size, row * size
+                img = evas.FilledImage(self.evas,
+                        file=self._tile_path(info['dir'], level, row, col))
+                img.preload()
+                self._grid.pack(img, x, y, min(size, W - x), min(size, H - y))
+                img.show()
+                self._tiles[key] = img
+                perf.count('tiles.load')
+        for key in [k for k in self._tiles if k not in needed]:
+            self._tiles.pop(key).delete()
+
+
 class ScrollablePhotocam(elm.Photocam, elm.Scrollable):
     ZOOMS = [0.05, 0.07, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5,
              2.0, 3.0, 5.0, 7.5, 10, 15, 20, 30, 50, 75, 100]
@@ -573,6 +1126,76 @@ class ScrollablePhotocam(elm.Photocam, elm.Scrollable):
     """
 
 
+class CompareView(elm.Table):
+    """ Show 2 or 4 photos side by side, with synchronized zoom and pan """
+    def __init__(self, parent, zoom_changed_cb):
+        self._zoom_changed_cb = zoom_changed_cb
+        self._syncing = False # avoid feedback loops while syncing panes
+        self.panes = []
+        self.mode = 2 # number of photos to compare
+        elm.Table.__init__(self, parent, homogeneous=True, padding=(2, 2),
+                           size_hint_expand=EXPAND_BOTH,
+                           size_hint_fill=FILL_BOTH)
+
+    def photos_set(self, paths, viewport):
+        """ Show paths, decoded to fit viewport (the slideshow size) """
+        if len(paths) != len(self.panes):
+            for pane in self.panes:
+                pane.delete()
+            self.panes = []
+            cols = 1 if len(paths) < 2 else 2
+            for i in range(len(paths)):
+                pane = ScrollablePhoto(self, self._pane_zoom_changed_cb,
+                                       size_hint_expand=EXPAND_BOTH,
+                                       size_hint_fill=FILL_BOTH)
+                pane.callback_scroll_add(self._pane_scroll_cb)
+                self.pack(pane, i % cols, i // cols, 1, 1)
+                pane.show()
+                self.panes.append(pane)
+
+        # the photos are already decoded by the slideshow (current and
+        # prefetched ones) and evas will share the pixels with the panes,
+        # only if they ask for the same decode size
+        for pane, path in zip(self.panes, paths):
+            pane.file_set(path, viewport)
+            pane.zoom_set('fit')
+            pane.animation_set(True)
+
+    def zoom_set(self, val):
+        self._syncing = True
+        for pane in self.panes:
+            pane.zoom_set(val)
+        self._syncing = False
+        if self.panes:
+            self._zoom_changed_cb(self.panes[0].zoom)
+
+    def _pane_zoom_changed_cb(self, zoom):
+        if self._syncing: return
+        self._syncing = True
+        for pane in self.panes:
+            if pane.zoom != zoom:
+                pane._zoom_mode = None
+                pane.zoom_centered(zoom)
+        self._syncing = False
+        self._zoom_changed_cb(zoom)
+
+    def _pane_scroll_cb(self, src):
+        if self._syncing: return
+        sx, sy, sw, sh = src.region
+        iw, ih = src.img.size_hint_min
+        if iw <= 0 or ih <= 0: return
+        # keep the same (relative) point at the center of all the panes
+        cx, cy = float(sx + sw / 2) / iw, float(sy + sh / 2) / ih
+        self._syncing = True
+        for pane in self.panes:
+            if pane is not src:
+                x, y, w, h = pane.region
+                iw, ih = pane.img.size_hint_min
+                pane.region_show(int(cx * iw - w / 2), int(cy * ih - h / 2),
+                                 w, h)
+        self._syncing = False
+
+
 class StatusBar(elm.Box):
     def __init__(self, parent):
         elm.Box.__init__(self, parent, horizontal=True,
@@ -589,35 +1212,98 @@ class StatusBar(elm.Box):
         self.pack_end(self.lb_info)
         self.lb_info.show()
 
+        # info button
+        bt = StdButton(self, icon='info')
+        bt.callback_clicked_add(self._info_clicked_cb)
+        bt.tooltip_text_set(_('Photo informations'))
+        self.pack_end(bt)
+        self.meta = None
+        self.resolution = 0, 0 # of the photo, also when not in meta
+
         # edit button
         # bt = StdButton(self, icon='edit')
         # bt.callback_clicked_add(lambda b: ImageEditor(self.app))
         # self.pack_end(bt)
         # self.btn_edit = bt
 
-    def update(self, img_path, img_num, tot_imgs, img_size, zoom):
+    @perf.timed('status.update')
+    def update(self, meta, resolution, img_num, tot_imgs, zoom):
+        self.meta = meta
+        self.resolution = resolution
         self.lb_name.text = '<align=left><b>{}:</b> {}</align>'.format(
                                 _('File {0} of {1}').format(img_num, tot_imgs),
-                                os.path.basename(img_path))
+                                os.path.basename(meta.path))
+        self.zoom_update(zoom)
+
+    def zoom_update(self, zoom):
         self.lb_info.text = \
             '<b>{}:</b> {}x{}    <b>{}:</b> {}    <b>{}:</b> {:.0f}%'.format(
-                _('Resolution'), img_size[0], img_size[1],
-                _('Size'), utils.file_hum_size(img_path),
+                _('Resolution'), self.resolution[0], self.resolution[1],
+                _('Size'), utils.hum_size(self.meta.size),
                 _('Zoom'), zoom)
 
+    def _info_clicked_cb(self, bt):
+        if self.meta is None: return
+        m = self.meta
+        rows = [
+            (_('File'), os.path.basename(m.path)),
+            (_('Resolution'), '{}x{}'.format(*self.resolution)),
+            (_('Size'), utils.hum_size(m.size)),
+            (_('Date'), m.date),
+            (_('Camera'), m.camera),
+            (_('Lens'), m.lens),
+            (_('Exposure'), m.exposure and (
+                             '1/{:.0f}s'.format(1 / m.exposure) if m.exposure < 1
+                             else '{:g}s'.format(m.exposure))),
+            (_('Aperture'), m.fnumber and 'f/{:g}'.format(m.fnumber)),
+            (_('ISO'), m.iso),
+            (_('Focal length'), m.focal and '{:g}mm'.format(m.focal)),
+        ]
+        text = '<br>'.join('<b>{}:</b> {}'.format(k, v) for k, v in rows if v)
+
+        app.win.freeze()
+        pop = elm.Ctxpopup(app.win, direction_priority=(
+                elm.ELM_CTXPOPUP_DIRECTION_UP, elm.ELM_CTXPOPUP_DIRECTION_LEFT,
+                elm.ELM_CTXPOPUP_DIRECTION_DOWN, elm.ELM_CTXPOPUP_DIRECTION_RIGHT))
+        pop.content = elm.Label(pop, text='<align=left>%s</align>' % text)
+        pop.callback_dismissed_add(self._popup_dismissed_cb)
+        x, y = self.evas.pointer_canvas_xy_get()
+        pop.move(x, y)
+        pop.show()
+
+    def _popup_dismissed_cb(self, pop):
+        app.win.unfreeze()
+        pop.delete()
+
 
 class SlideShow(elm.Slideshow):
     TRANSITIONS = ('fade', 'fade_fast', 'black_fade', 'horizontal', 'vertical',
                    'square', 'immediate')
-    def __init__(self, parent, photo_changed_cb, zoom_changed_cb):
+    SORT_LABELS = {'name': 'Sort by name', 'date': 'Sort by date',
+                   'mtime': 'Sort by modification time',
+                   'size': 'Sort by file size', 'pixels': 'Sort by dimensions'}
+    WINDOW = 2 # real items kept before and after the current photo
+
+    def __init__(self, parent, model, photo_changed_cb, zoom_changed_cb):
+        self.model = model
         self._photo_changed_cb = photo_changed_cb
         self._zoom_changed_cb = zoom_changed_cb
+        self._items = {} # Photo -> SlideshowItem, only the window ones
+        self._rank = {}  # Photo -> order in the window, for sorted inserts
+        self._current = None # the current item
+        self._shown = None # the previous one, kept until the transition end
+        self._prefetch_timer = None
+        self._prefetch_cache = LRUCache(options.prefetch_cache_mb * 1024 * 1024,
+                                        self._prefetch_evict_cb, 'prefetch')
 
         self.itc = elm.SlideshowItemClass(self._item_get_func)
+        # only build the current item, neighbours are prefetched by us
         elm.Slideshow.__init__(self, parent, style='eluminance',
                                loop=options.sshow_loop, 
-                               transition=options.sshow_transition)
+                               transition=options.sshow_transition,
+                               cache_before=0, cache_after=0)
         self.callback_changed_add(self._changed_cb)
+        self.callback_transition_end_add(self._transition_end_cb)
 
         buttons = [ # (mode, tooltip, icon, action)
             (None, _('Zoom in'), 'zoom-in', 'in'),
@@ -632,6 +1318,10 @@ class SlideShow(elm.Slideshow):
             ('spinner', _('Transition time'), None, None),
             ('hover', _('Transition style'), None, None),
             ('sep', None, None, None),
+            ('sort', _('Order of the photos'), None, None),
+            ('days', _('Group the photos by capture day'), None, None),
+            ('sep', None, None, None),
+            (None, _('Compare mode (1, 2 or 4 photos)'), 'view-dual', 'compare'),
             (None, _('Toggle fullscreen mode'), 'view-fullscreen', 'fs'),
             (None, _('Eluminance info'), 'help-about', 'info'),
         ]
@@ -660,6 +1350,21 @@ class SlideShow(elm.Slideshow):
                 for t in self.TRANSITIONS:
                     w.item_add(t, None, 0, self._transition_cb, t)
                 self.hs_transition = w
+            # Sort selector
+            elif mode == 'sort':
+                w = elm.Hoversel(self, hover_parent=parent,
+                                 text=_(self.SORT_LABELS[options.sort_mode]))
+                w.callback_clicked_add(lambda h: app.win.freeze())
+                w.callback_dismissed_add(lambda h: app.win.unfreeze())
+                for m in SORT_MODES:
+                    w.item_add(_(self.SORT_LABELS[m]), None, 0,
+                               self._sort_cb, m)
+                self.hs_sort = w
+            # Group by day check
+            elif mode == 'days':
+                w = elm.Check(self, text=_('Group by day'),
+                              state=options.group_by_day)
+                w.callback_changed_add(self._days_cb)
             # normal buttons
             else: 
                 w = StdButton(self, icon=icon)
@@ -669,16 +1374,102 @@ class SlideShow(elm.Slideshow):
             if tooltip: w.tooltip_text_set(tooltip)
             w.show()
 
-    def photo_add(self, path):
-        item_data = (path, self.count + 1)
-        item = self.item_add(self.itc, item_data)
-        # XXX the first added item get the changed_cb called before
-        # python-efl can do the _set_obj, so we get a null item.object in the cb
-        if self.count == 1 and item.object:
-            self._photo_changed_cb(path)
-
-    def photo_nth_show(self, index):
-        self.nth_item_get(index).show()
+    def photos_added(self):
+        """ Photos have been added to the model, fill the window """
+        item = self.current_item
+        if item is None:
+            if len(self.model):
+                self._window_set(0)
+        else:
+            self._window_set(self.model.index(item.data))
+
+    def photos_removed(self, removed):
+        """ Photos have been removed from the model, and maybe added
+
+        removed is a list of (photo, pos) with the position of each photo
+        when it was removed.
+        """
+        current_pos = None
+        for photo, pos in removed:
+            item = self._items.pop(photo, None)
+            if item is None:
+                continue
+            if item is self._shown:
+                self._shown = None
+            if item is self._current:
+                self._current = None
+                current_pos = pos
+            item.delete()
+        if not len(self.model):
+            return
+        if self.current_item is None: # it was removed
+            self._window_set(min(current_pos or 0, len(self.model) - 1),
+                             show=True)
+        else:
+            self._window_set(self.model.index(self.current_item.data))
+
+    def photos_reordered(self):
+        """ The model has been sorted, keep only the current photo """
+        current = self.current_item
+        for photo, item in list(self._items.items()):
+            if item is not current:
+                del self._items[photo]
+                item.delete()
+        self._shown = None
+        if current is not None:
+            self._window_set(self.model.index(current.data))
+
+    def photo_show(self, path):
+        photo = self.model.get(path)
+        if photo is not None:
+            self._window_set(self.model.index(photo), show=True)
+
+    def _window_set(self, pos, show=False):
+        """ Have real items only for the photos around pos """
+        positions = self.model.around(pos, self.WINDOW, self.WINDOW, self.loop)
+        photos = [self.model[i] for i in positions]
+        target = self.model[pos]
+        current = self.current_item
+        # the current and the previous item (maybe in transition) are kept
+        keep = (current, self._shown)
+        in_window = set(photos)
+        for photo in [p for p in self._items if p not in in_window]:
+            if self._items[photo] not in keep:
+                self._items.pop(photo).delete()
+        # items are sorted by model position, relative to pos when wrapping
+        count = len(self.model)
+        wrap = count if len(photos) < count and self.loop else 0
+        self._rank = {}
+        others = [p for p in self._items if p not in in_window]
+        for i, photo in list(zip(positions, photos)) + \
+                        [(self.model.index(p), p) for p in others]:
+            if wrap:
+                i = (i - pos + wrap // 2) % wrap - wrap // 2
+            self._rank[photo] = i
+        # the target first, an empty slideshow show the first added item
+        for photo in [target] + photos:
+            if photo not in self._items:
+                self._items[photo] = self.item_sorted_insert(self.itc,
+                                                    self._item_cmp, photo)
+        item = self._items[target]
+        if current is None:
+            # XXX the first added item get the changed_cb called before
+            # python-efl can do the _set_obj, so we get a null item.object
+            if item is self.current_item and item.object:
+                self._changed_cb(self, item)
+            elif item is not self.current_item:
+                item.show()
+        elif show and item is not current:
+            item.show()
+
+    def _item_cmp(self, it1, it2):
+        return self._rank[it1.data] - self._rank[it2.data]
+
+    def clear(self):
+        self._items = {}
+        self._rank = {}
+        self._current = self._shown = None
+        elm.Slideshow.clear(self)
 
     def play(self):
         self.timeout = options.sshow_timeout
@@ -700,21 +1491,102 @@ class SlideShow(elm.Slideshow):
 
     @property
     def index(self):
-        path, index = self.current_item.data
-        return index
+        """ Position of the current photo, starting from 1 """
+        return self.model.index(self.current_item.data) + 1
 
-    def _item_get_func(self, obj, item_data):
-        path, index = item_data
+    def _item_get_func(self, obj, photo):
+        path = photo.path
         # img = ScrollablePhotocam(self, self._zoom_changed_cb)
-        img = ScrollablePhoto(self, self._zoom_changed_cb)
-        img.file_set(path)
+        if _is_huge(path):
+            img = TiledPhoto(self, self._zoom_changed_cb)
+        else:
+            img = ScrollablePhoto(self, self._zoom_changed_cb)
+        # prefetched photos are already decoded, no need for the preview
+        img.file_set(path, self.size, path not in self._prefetch_cache)
         img.zoom_set('fit')
         return img
 
     def _changed_cb(self, obj, item):
-        if item.object: # XXX see below note in photo_add()
-            path, index = item.data
-            self._photo_changed_cb(path)
+        if item.object: # XXX see the note in _window_set()
+            if item is not self._current:
+                # only the photo on screen is animated
+                if self._current is not None and self._current.object:
+                    self._current.object.animation_set(False)
+                self._shown, self._current = self._current, item
+            item.object.animation_set(app.compare is None)
+            index = self.index - 1
+            app.budget.focus(index, len(self.model) if self.loop else 0)
+            self._photo_changed_cb(item.data.path)
+            # move the window and prefetch the neighbours as soon as the
+            # current photo is on screen
+            if self._prefetch_timer is not None:
+                self._prefetch_timer.delete()
+            self._prefetch_timer = ecore.Timer(0.0, self._prefetch_timer_cb)
+
+    def _prefetch_timer_cb(self):
+        self._prefetch_timer = None
+        current = self.current_item
+        if current is None:
+            return ecore.ECORE_CALLBACK_CANCEL
+        index = self.model.index(current.data)
+        self._window_set(index)
+        count = len(self.model)
+        offsets = list(range(1, options.prefetch_next + 1)) + \
+                  list(range(-1, -options.prefetch_prev - 1, -1))
+        for offset in reversed(offsets): # nearest next is the most recent
+            i = index + offset
+            if self.loop:
+                i %= count
+            elif not 0 <= i < count:
+                continue
+            self.prefetch(self.model[i].path, i)
+        return ecore.ECORE_CALLBACK_CANCEL
+
+    def _transition_end_cb(self, obj, *args):
+        # the previous photo is off screen now
+        self._shown = None
+        if self.current_item is not None:
+            self._window_set(self.model.index(self.current_item.data))
+
+    def photos_from_current(self, num):
+        """ Paths of the current photo and of the num-1 following ones """
+        count, index = len(self.model), self.index - 1
+        return [self.model[(index + i) % count].path
+                for i in range(min(num, count))]
+
+    def prefetch(self, path, position=None):
+        """ Keep the decoded pixels of path in the prefetch cache """
+        if self._prefetch_cache.get(path) is None:
+            self._prefetch(path, position)
+
+    def _prefetch(self, path, position):
+        if _is_huge(path):
+            # never decode those, but have the tiles ready
+            app.pyramids.request(path, lambda *args: None)
+            return
+        if archives.split(path) is not None:
+            return # evas cannot share the decode of a memfile
+        # Evas share decoded images between objects that load the same file
+        # with the same options, an hidden preloaded image keep the pixels
+        # ready for the photo widget, decoded at the size it will ask for
+        img = evas.Image(self.evas)
+        prescale = _fit_prescale(path, self.size)[0]
+        if prescale:
+            img.load_size = prescale, prescale
+        img.file = path
+        w, h = img.image_size
+        if w <= 0 or h <= 0:
+            img.delete()
+            return
+        img.preload()
+        self._prefetch_cache.put(path, img, w * h * 4)
+        if path in self._prefetch_cache:
+            app.budget.add(('prefetch', path), w * h * 4,
+                           lambda: self._prefetch_cache.evict(path), position)
+
+    def _prefetch_evict_cb(self, path, img):
+        img.delete()
+        app.budget.remove(('prefetch', path))
 
     def _buttons_cb(self, bt, action):
         if action == 'next':
@@ -727,8 +1599,13 @@ class SlideShow(elm.Slideshow):
             app.win.fullscreen = not app.win.fullscreen
         elif action == 'info':
             InfoWin(app.win)
+        elif action == 'compare':
+            app.compare_cycle()
         elif action in ('in', 'out', 'fit', 'fill', '1:1'):
-            self.photo.zoom_set(action)
+            if app.compare is not None:
+                app.compare.zoom_set(action)
+            else:
+                self.photo.zoom_set(action)
 
     def _spinner_cb(self, spinner):
         options.sshow_timeout = spinner.value
@@ -739,6 +1616,15 @@ class SlideShow(elm.Slideshow):
         self.transition = options.sshow_transition = transition
         self.hs_transition.text = _(transition)
 
+    def _sort_cb(self, hoversel, item, mode):
+        options.sort_mode = mode
+        self.hs_sort.text = _(self.SORT_LABELS[mode])
+        app.photos_sort()
+
+    def _days_cb(self, check):
+        options.group_by_day = check.state
+        app.photos_sort()
+
 
 class InfoWin(elm.DialogWindow):
     def __init__(self, parent):
@@ -805,6 +1691,26 @@ class InfoWin(elm.DialogWindow):
         self.show()
 
 
+class PerfOverlay(elm.Label):
+    """ The perf stats, live updated on top of the window """
+    INTERVAL = 1.0
+
+    def __init__(self, parent):
+        elm.Label.__init__(self, parent, repeat_events=True)
+        self.layer = evas.EVAS_LAYER_MAX - 1
+        self.move(10, 10)
+        self.show()
+        self._timer = ecore.Timer(self.INTERVAL, self._update_cb)
+        self.on_del_add(lambda o: self._timer.delete())
+        self._update_cb()
+
+    def _update_cb(self):
+        lines = perf.summary() or [_('No data yet')]
+        self.text = '<font_size=10>{}</font_size>'.format('<br>'.join(lines))
+        self.resize(*self.size_hint_min)
+        return ecore.ECORE_CALLBACK_RENEW
+
+
 class MainWin(elm.StandardWindow):
     def __init__(self):
         elm.StandardWindow.__init__(self, 'eluminance', 'Eluminance',
@@ -832,72 +1738,333 @@ class MainWin(elm.StandardWindow):
 
 
 class EluminanceApp(object):
-    def __init__(self):
+    MEMORY_CHECK_INTERVAL = 2.0
+    # the model order used to sort by name: natural order of the full paths
+    # for the photos below a folder (as they are scanned), the catalog order
+    # for search results
+    VIEW_ORDERS = {'folder': 'name', 'recursive': 'path', 'search': 'added'}
+
+    def __init__(self, request=None):
+        self.budget = MemoryBudget(options.memory_budget_mb * 1024 * 1024)
+        self.thumbs = None # started in startup()
+        self.pyramids = None # started in startup()
         self.win = MainWin()
-        self.sshow = SlideShow(self.win, self.photo_changed, self.zoom_changed)
-        self.grid = PhotoGrid(self.win, self.grid_selected)
-        self.tree = TreeView(self.win, self.tree_selected)
+        self.model = FolderModel()
+        self.sshow = SlideShow(self.win, self.model,
+                               self.photo_changed, self.zoom_changed)
+        self.grid = PhotoGrid(self.win, self.model, self.grid_selected)
+        self.watcher = FolderWatcher(self.folder_changed)
+        self.tree = TreeView(self.win, self.tree_selected, self.search,
+                             self.watcher)
         self.status = StatusBar(self.win)
+        self.compare = None
         self.win.swallow_all(self)
 
         home = os.path.expanduser('~')
         self.current_path = home
         self.current_file = None
-        request = None
+        self._scanner = None
+        self._reader = None # the metadata of the photos sorted last
+        self._select_on_scan = None
+        self._watched = None # the folder shown in the grid, if watched
+        self._view = None # what the grid shows, once sortable: VIEW_ORDERS
+        self._request = None
+
+        if request:
+            request = os.path.abspath(request)
+            if os.path.exists(request):
+                self._request = request
 
-        if len(sys.argv) > 1:
-            request = os.path.abspath(sys.argv[1])
-            if not os.path.exists(request):
-                request = None
+        self.win.show()
+
+    def startup(self, profile):
+        """ All the work not needed to show the window
+
+        Called on the first idle of the main loop, when the window is
+        already on screen.
+        """
+        profile.phase('first frame')
+        # PIL and multiprocessing are heavy to import
+        import eluminance.thumbnails as thumbnails
+        if thumbnails.available():
+            self.thumbs = thumbnails.ThumbnailService(options.thumb_workers)
+        else:
+            elm.need_ethumb()
+        import eluminance.tiles as tiles
+        if tiles.available():
+            self.pyramids = tiles.PyramidService(options.tiles_cache_mb)
+        profile.phase('thumbnails')
 
+        home = os.path.expanduser('~')
+        request = self._request
         if request:
             if request.startswith(home):
                 self.tree.set_root(home)
             else:
                 self.tree.set_root('/')
+            if os.path.isfile(request) and not archives.is_archive(request):
+                self._select_on_scan = request
             self.tree.expand_to_folder(request)
-            if os.path.isfile(request):
-                self.grid.file_select(request)
         else:
             self.tree.set_root(home)
-
-        self.win.show()
-
-    def tree_selected(self, path):
+        profile.phase('tree')
+        ecore.Timer(self.MEMORY_CHECK_INTERVAL, self._memory_check_cb)
+        profile.report()
+        return ecore.ECORE_CALLBACK_CANCEL
+
+    def _memory_check_cb(self):
+        # the system is swapping, keep only what is on screen
+        if memory_pressure():
+            perf.count('memory.pressure')
+            self.budget.shrink(0)
+            elm.cache_all_flush()
+        return ecore.ECORE_CALLBACK_RENEW
+
+    def _photos_clear(self, path):
+        """ Stop the current scan and empty the grid and the slideshow """
+        if self._scanner is not None:
+            self._scanner.cancel()
+            self._scanner = None
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
         self.current_path = path
+        self._view = None
         self.sshow.clear()
         self.grid.clear()
-        for f in utils.natural_sort(os.listdir(path)):
-            if os.path.splitext(f)[-1].lower() in IMG_EXTS:
-                full_path = os.path.join(path, f)
-                self.grid.photo_add(full_path)
-                self.sshow.photo_add(full_path)
+        self.model.clear()
+        if self._watched is not None:
+            self.watcher.unwatch(self._watched)
+            self._watched = None
+
+    def tree_selected(self, path, recursive=False):
+        self._photos_clear(path)
+        if not recursive and archives.split(path) is None:
+            # new photos are only shown for plain folders
+            self.watcher.watch(path)
+            self._watched = path
+        self._scanner = FolderScanner(path, self._scan_batch_cb,
+                                      self._scan_done_cb, recursive)
         self.win.title = 'eluminance - ' + self.current_path
-
-    def grid_selected(self, path, index):
-        self.sshow.photo_nth_show(index)
+        if recursive:
+            self.win.title += ' (%s)' % _('all photos below')
+
+    def _scan_batch_cb(self, paths):
+        # photos already added by the watcher are skipped by the model
+        self.grid.photos_add(self.model.append(paths))
+        self.sshow.photos_added()
+        if self._select_on_scan in paths:
+            self.grid.file_select(self._select_on_scan)
+            self._select_on_scan = None
+
+    def _scan_done_cb(self, scanner):
+        self._scanner = None
+        self._select_on_scan = None
+        self._view = 'recursive' if scanner.recursive else 'folder'
+        if options.sort_mode != 'name' or options.group_by_day:
+            self.photos_sort()
+
+    def photos_sort(self, read_missing=True):
+        """ Apply the sort options to the photos shown
+
+        Scans add the photos in name order, so this is called once the scan
+        is done, to change the order only one time. The name order depends on
+        the view, the duplicates groups are never sorted.
+        The photos never read are sorted last, their metadata is then read in
+        background and they are sorted again when done.
+        """
+        if self._view is None or self._scanner is not None:
+            return
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        mode = options.sort_mode
+        if mode == 'name':
+            mode = self.VIEW_ORDERS[self._view]
+        with perf.timer('model.sort'):
+            missing = self.model.sort(mode)
+            self.grid.photos_set(self.model, self.model.day
+                                 if options.group_by_day else None)
+            self.sshow.photos_reordered()
+        if self.current_file:
+            self.grid.file_select(self.current_file)
+        if missing and read_missing:
+            self._reader = MetadataReader(missing, self._metadata_read_cb)
+
+    def _metadata_read_cb(self, reader):
+        self._reader = None
+        self.photos_sort(read_missing=False)
+
+    def folder_changed(self, folder, names, renames):
+        self.tree.folder_changed(folder, names, renames)
+        if folder != self._watched:
+            return
+        if names is None: # too many changes, read the folder again
+            self.tree_selected(folder)
+            return
+        current = self.current_file
+        added, removed = False, []
+        for name in files.natural_sort(names):
+            path = os.path.join(folder, name)
+            if files.is_image(name) and os.path.isfile(path):
+                if path in self.model:
+                    self.grid.photo_update(path)
+                else:
+                    pos, photo = self.model.insert(path)
+                    self.grid.photo_insert(photo, pos)
+                    added = True
+            elif path in self.model:
+                pos, photo = self.model.remove(path)
+                self.grid.photo_remove(path)
+                removed.append((photo, pos))
+        # the slideshow is updated once for the whole burst of changes
+        if removed:
+            self.sshow.photos_removed(removed)
+        elif added:
+            self.sshow.photos_added()
+        # keep showing the current photo if it has been renamed
+        for old, new in renames:
+            new = os.path.join(folder, new)
+            if current == os.path.join(folder, old) and new in self.model:
+                self.grid.file_select(new)
+
+    def search(self, text):
+        """ Show the photos of the catalog that match text """
+        self._photos_clear(self.current_path)
+        with perf.timer('catalog.search'):
+            paths = catalog.instance().search(text)
+        # files deleted since they were cataloged are not checked here, a
+        # stat for every result would be too slow on network filesystems,
+        # they are just shown without thumbnail
+        self.grid.photos_add(self.model.append(paths))
+        self.sshow.photos_added()
+        self._view = 'search'
+        if options.sort_mode != 'name' or options.group_by_day:
+            self.photos_sort()
+        self.win.title = 'eluminance - {} ({})'.format(text,
+                             ngettext('{} photo found', '{} photos found',
+                                      len(paths)).format(len(paths)))
+
+    def find_duplicates(self, path):
+        """ Show the groups of similar photos found below path """
+        self._photos_clear(path)
+        import eluminance.dupes as dupes # numpy is heavy to import
+        self._scanner = dupes.DupesFinder(path, self._dupes_found_cb)
+        self.win.title = 'eluminance - {} ({})'.format(
+                             path, _('searching duplicates...'))
+
+    def _dupes_found_cb(self, groups):
+        self._scanner = None
+        for num, group in enumerate(groups, 1):
+            self.grid.group_add(ngettext('Group {0}: {1} photo',
+                                         'Group {0}: {1} photos',
+                                         len(group)).format(num, len(group)))
+            self.grid.photos_add(self.model.append(group))
+        self.sshow.photos_added()
+        self.win.title = 'eluminance - {} ({})'.format(
+                             self.current_path,
+                             ngettext('{} group of duplicates',
+                                      '{} groups of duplicates',
+                                      len(groups)).format(len(groups)))
+
+    def compare_cycle(self):
+        """ Switch between normal, 2 photos and 4 photos compare modes """
+        mode = {None: 2, 2: 4, 4: None}[self.compare and self.compare.mode]
+        if mode is None or len(self.model) < 2:
+            if self.compare is not None:
+                self.win.layout.content_unset('photo.swallow')
+                self.compare.delete()
+                self.compare = None
+                self.win.layout.content_set('photo.swallow', self.sshow)
+                self.sshow.show()
+                if self.sshow.current_item is not None:
+                    self.sshow.photo.animation_set(True)
+            return
+        if self.compare is None:
+            self.compare = CompareView(self.win, self.zoom_changed)
+            self.win.layout.content_unset('photo.swallow')
+            self.sshow.hide()
+            if self.sshow.current_item is not None:
+                self.sshow.photo.animation_set(False)
+            self.win.layout.content_set('photo.swallow', self.compare)
+            self.compare.show()
+        self.compare.mode = mode
+        self._compare_update()
+
+    def _compare_update(self):
+        paths = self.sshow.photos_from_current(self.compare.mode)
+        for path in paths:
+            self.sshow.prefetch(path)
+        self.compare.photos_set(paths, self.sshow.size)
+
+    def grid_selected(self, path):
+        self.sshow.photo_show(path)
 
     def photo_changed(self, path):
         self.current_file = path
         self.grid.file_select(path)
-        self.status.update(self.current_file, self.sshow.index, self.sshow.count,
-                           self.sshow.photo.image_size, 0)
+        if self.compare is not None:
+            self._compare_update()
+        try:
+            meta = metadata.get(path)
+        except OSError as e:
+            print("ERROR: Cannot read '%s': %s" % (path, e))
+            return
+        resolution = meta.width, meta.height
+        if not meta.width: # format not supported by the metadata reader
+            resolution = self.sshow.photo.image_size
+        self.status.update(meta, resolution, self.sshow.index,
+                           len(self.model), 0)
 
     def zoom_changed(self, zoom):
-        # TODO update only the zoom
-        self.status.update(self.current_file, self.sshow.index, self.sshow.count,
-                           self.sshow.photo.image_size, zoom)
+        if self.status.meta is not None:
+            self.status.zoom_update(zoom)
 
 
 def main():
+    parser = argparse.ArgumentParser(prog='eluminance',
+                                     description=_('Fast photo browser'))
+    parser.add_argument('path', nargs='?',
+                        help=_('folder to open, or photo to show'))
+    parser.add_argument('--startup-profile', action='store_true',
+                        help=_('print the time spent in each startup phase'))
+    parser.add_argument('--perf', action='store_true',
+                        help=_('time the hot paths, stats are saved on exit'))
+    parser.add_argument('--perf-overlay', action='store_true',
+                        help=_('show the live stats on screen (imply --perf)'))
+    args = parser.parse_args()
+    if args.perf or args.perf_overlay:
+        perf.enable()
+
+    profile = utils.PhaseTimer(args.startup_profile, IMPORT_START)
+    profile.phase('imports')
     options.load()
-    elm.need_ethumb()
+    profile.phase('options')
     elm.theme_extension_add(THEME_FILE)
+    profile.phase('theme')
 
     global app
-    app = EluminanceApp()
+    app = EluminanceApp(args.path)
+    if args.perf_overlay:
+        PerfOverlay(app.win)
+    profile.phase('widgets')
+    # everything else once the window is on screen
+    ecore.Idler(app.startup, profile)
     elm.run()
+    if app.thumbs is not None:
+        app.thumbs.shutdown()
+    if app.pyramids is not None:
+        app.pyramids.shutdown()
+    app.watcher.shutdown()
     options.save()
+    if perf.enabled:
+        perf_path = os.path.join(xdg_cache_home, 'eluminance')
+        if not os.path.exists(perf_path):
+            os.makedirs(perf_path)
+        perf_file = os.path.join(perf_path,
+                                 time.strftime('perf-%Y%m%d-%H%M%S.json'))
+        perf.dump(perf_file)
+        print('Performance stats saved to: %s' % perf_file)
 
 if __name__ == '__main__':
     sys.exit(main())
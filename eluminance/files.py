@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" File names: which ones are images, and their natural order
+
+Nothing here needs efl, so that the headless tools (indexer, benchmarks)
+can list and sort folders without the gui.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import re
+
+try:
+    from os import scandir
+except ImportError: # python < 3.5
+    from scandir import scandir
+
+
+IMG_EXTS = ('.jpg','.jpeg','.png','.gif','.tiff','.bmp')
+
+def is_image(file_name):
+    return os.path.splitext(file_name)[-1].lower() in IMG_EXTS
+
+_natural_split = re.compile('([0-9]+)').split
+
+def natural_key(name):
+    """ Sort key to order names in the natural way: 'img2' before 'img10'
+
+    The key is a single string, as comparing strings is much faster than
+    comparing lists or tuples of mixed ints and strings. Every number is
+    encoded as NUL + chr(number of digits) + digits (without leading zeros)
+    so that shorter numbers come first and numbers come before any text.
+    The name itself is appended, after a NUL NUL separator, as the final
+    tie-breaker (for 'a1' and 'A01').
+    """
+    parts = _natural_split(name.lower())
+    for i in range(1, len(parts), 2):
+        num = parts[i].lstrip('0') or '0'
+        parts[i] = '\0' + chr(len(num)) + num
+    parts.append('\0\0')
+    parts.append(name)
+    return ''.join(parts)
+
+def natural_sort(l):
+    return sorted(l, key=natural_key)
+
+def natural_bisect(seq, name, name_get):
+    """ Position where name must be inserted in the natural sorted seq
+
+    name_get(element) must return the name of each element of seq.
+    """
+    key = natural_key(name)
+    lo, hi = 0, len(seq)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if natural_key(name_get(seq[mid])) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Headless indexing of a whole photo tree
+
+Walk the tree and bring all the caches up to date: folder listings,
+thumbnails, metadata and duplicates hashes (in the catalog), so that
+browsing it later or searching the duplicates will
+not need to read or decode anything. Entries already up to date are
+skipped, so it's cheap to run it again, for example from a nightly cron:
+
+    eluminance --index ~/Pictures --jobs 4
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+import eluminance.catalog as catalog
+import eluminance.metadata as metadata
+import eluminance.dupes as dupes
+import eluminance.thumbnails as thumbnails
+from eluminance.scanner import walk_images
+
+
+REPORT_INTERVAL = 2.0 # seconds
+STORE_BATCH = 500     # metadata rows per catalog transaction
+
+
+def index_image(task):
+    """ Worker: update the caches of one image
+
+    Return (path, metadata row or None, thumbnail generated, hash row or None)
+    """
+    path, known_mtime, hash_mtime, size = task
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return path, None, False, None
+    generated = False
+    thumb = None
+    if size:
+        thumb = thumbnails.thumb_lookup(path, size)
+        if thumb is None:
+            thumb = thumbnails.thumb_generate(path, size)[1]
+            generated = True
+    row = None
+    if known_mtime != mtime:
+        row = metadata.read(path).to_row()
+    hash_row = None
+    if hash_mtime != mtime and dupes.available():
+        dhash = dupes.dhash_files([thumb or path])[0]
+        if dhash is not None:
+            hash_row = (path, mtime, dhash)
+    return path, row, generated, hash_row
+
+
+class Indexer(object):
+    """ Index the tree at root using a pool of jobs processes """
+    def __init__(self, root, jobs=0, size='normal'):
+        self.root = os.path.abspath(root)
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.size = size if thumbnails.available() else None
+        self.images = self.thumbs = self.metas = self.hashes = 0
+        self.skipped = 0
+        self.start = None
+
+    def _tasks(self):
+        cat = catalog.instance()
+        for folder, names in walk_images(self.root):
+            paths = [os.path.join(folder, n) for n in names]
+            known = cat.images_mtime(paths)
+            hashes = cat.hashes_get(paths)
+            for path in paths:
+                yield (path, known.get(path),
+                       hashes.get(path, (None, None))[0], self.size)
+
+    def run(self):
+        if self.size is None:
+            print('PIL not available, thumbnails will not be generated')
+        cat = catalog.instance()
+        pool = multiprocessing.Pool(self.jobs)
+        rows, hash_rows = [], []
+        self.start = last_report = time.time()
+        try:
+            for path, row, generated, hash_row in pool.imap_unordered(
+                                            index_image, self._tasks(), 16):
+                self.images += 1
+                self.thumbs += generated
+                if not generated and row is None and hash_row is None:
+                    self.skipped += 1
+                if row is not None:
+                    self.metas += 1
+                    rows.append(row)
+                if hash_row is not None:
+                    self.hashes += 1
+                    hash_rows.append(hash_row)
+                if len(rows) + len(hash_rows) >= STORE_BATCH:
+                    cat.images_set(rows)
+                    cat.hashes_set(hash_rows)
+                    rows, hash_rows = [], []
+                if time.time() - last_report > REPORT_INTERVAL:
+                    last_report = time.time()
+                    self.report()
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            cat.images_set(rows)
+            cat.hashes_set(hash_rows)
+            pool.join()
+        self.report()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        rate = self.images / elapsed if elapsed > 0 else 0.0
+        print('%d images in %.1fs (%.1f/s): %d thumbnails generated, '
+              '%d metadata read, %d hashes computed, %d already up to date' %
+              (self.images, elapsed, rate, self.thumbs, self.metas,
+               self.hashes, self.skipped))
+        sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='eluminance --index',
+                 description='Pre-build thumbnails and metadata of a tree')
+    parser.add_argument('--index', metavar='DIR', required=True,
+                        help='root of the tree to index')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='worker processes (default: one per cpu)')
+    parser.add_argument('--size', choices=sorted(thumbnails.SIZES),
+                        default='normal', help='thumbnails size')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.index):
+        print("ERROR: Not a folder: '%s'" % args.index)
+        return 1
+    try:
+        Indexer(args.index, args.jobs, args.size).run()
+    except KeyboardInterrupt:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
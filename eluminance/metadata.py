@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+import os
+import io
+import struct
+
+import eluminance.perf as perf
+import eluminance.catalog as catalog
+import eluminance.archives as archives
+from eluminance.cache import LRUCache
+
+class Metadata(object):
+    """ Photo informations, read from the file headers only """
+    __slots__ = ('path', 'mtime', 'size', 'width', 'height', 'orientation',
+                 'date', 'make', 'model', 'lens', 'exposure', 'fnumber',
+                 'iso', 'focal')
+
+    def __init__(self, path, mtime, size):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.width = self.height = 0
+        self.orientation = 1
+        self.date = self.make = self.model = self.lens = None
+        self.exposure = self.fnumber = self.focal = None
+        self.iso = None
+
+    @classmethod
+    def from_row(cls, row):
+        """ Build from a catalog row, the values are in __slots__ order """
+        meta = cls.__new__(cls)
+        for attr, val in zip(cls.__slots__, row):
+            setattr(meta, attr, val)
+        return meta
+
+    def to_row(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    @property
+    def camera(self):
+        if self.make and self.model and not self.model.startswith(self.make):
+            return '%s %s' % (self.make, self.model)
+        return self.model or self.make
+
+
+# TIFF/EXIF tags we care of: tag -> Metadata attribute
+TAGS_IFD0 = {
+    0x0100: 'width', 0x0101: 'height', 0x010F: 'make', 0x0110: 'model',
+    0x0112: 'orientation', 0x0132: 'date',
+}
+TAGS_EXIF = {
+    0x829A: 'exposure', 0x829D: 'fnumber', 0x8827: 'iso', 0x9003: 'date',
+    0x920A: 'focal', 0xA434: 'lens',
+}
+TAGS_IFD0_JPEG = dict((k, v) for k, v in TAGS_IFD0.items()
+                      if v not in ('width', 'height')) # use SOF for these
+TAG_EXIF_IFD = 0x8769
+TAG_PREVIEW_OFFSET = 0x0201 # JPEGInterchangeFormat
+TAG_PREVIEW_LENGTH = 0x0202 # JPEGInterchangeFormatLength
+
+# TIFF types: type -> (struct format, size)
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    7: ('B', 1), 9: ('i', 4), 10: ('ii', 8),
+}
+
+JPEG_SOF = set(range(0xC0, 0xD0)) - set((0xC4, 0xC8, 0xCC))
+
+
+def _tiff_value(f, base, endian, typ, count, raw):
+    fmt, size = TIFF_TYPES[typ]
+    if count * size > 4:
+        f.seek(base + struct.unpack(endian + 'I', raw)[0])
+        raw = f.read(count * size)
+    if typ == 2:
+        return raw[:count].split(b'\0', 1)[0].decode('latin-1').strip()
+    if typ in (5, 10):
+        num, den = struct.unpack(endian + fmt, raw[:8])
+        return float(num) / den if den else 0.0
+    return struct.unpack(endian + fmt, raw[:size])[0]
+
+def _tiff_ifd(f, base, endian, offset, tags, meta):
+    """ Read the wanted tags of the IFD at offset, return the exif IFD ptr """
+    f.seek(base + offset)
+    count = struct.unpack(endian + 'H', f.read(2))[0]
+    entries = f.read(count * 12)
+    exif_ifd = None
+    for i in range(0, len(entries) - 11, 12):
+        tag, typ, num = struct.unpack(endian + 'HHI', entries[i:i+8])
+        if tag == TAG_EXIF_IFD:
+            exif_ifd = struct.unpack(endian + 'I', entries[i+8:i+12])[0]
+        elif tag in tags and typ in TIFF_TYPES and num > 0:
+            val = _tiff_value(f, base, endian, typ, num, entries[i+8:i+12])
+            setattr(meta, tags[tag], val)
+    return exif_ifd
+
+def _parse_tiff(f, base, meta, ifd0_tags=TAGS_IFD0):
+    """ Parse a TIFF structure (a TIFF file or an EXIF block) at base """
+    f.seek(base)
+    order = f.read(4)
+    if order == b'II*\0':
+        endian = '<'
+    elif order == b'MM\0*':
+        endian = '>'
+    else:
+        return
+    offset = struct.unpack(endian + 'I', f.read(4))[0]
+    exif_ifd = _tiff_ifd(f, base, endian, offset, ifd0_tags, meta)
+    if exif_ifd: # DateTimeOriginal here will override the IFD0 DateTime
+        _tiff_ifd(f, base, endian, exif_ifd, TAGS_EXIF, meta)
+
+def _tiff_previews(f, base):
+    """ The (offset, length) of the jpeg previews in IFD0 and IFD1 """
+    f.seek(base)
+    order = f.read(4)
+    if order == b'II*\0':
+        endian = '<'
+    elif order == b'MM\0*':
+        endian = '>'
+    else:
+        return []
+    offset = struct.unpack(endian + 'I', f.read(4))[0]
+    previews = []
+    for ifd in range(2):
+        if not offset:
+            break
+        f.seek(base + offset)
+        count = struct.unpack(endian + 'H', f.read(2))[0]
+        entries = f.read(count * 12)
+        found = {}
+        for i in range(0, len(entries) - 11, 12):
+            tag, typ = struct.unpack(endian + 'HH', entries[i:i+4])
+            if tag in (TAG_PREVIEW_OFFSET, TAG_PREVIEW_LENGTH) and typ in (3, 4):
+                fmt, size = TIFF_TYPES[typ]
+                found[tag] = struct.unpack(endian + fmt,
+                                           entries[i+8:i+8+size])[0]
+        if len(found) == 2:
+            previews.append((base + found[TAG_PREVIEW_OFFSET],
+                             found[TAG_PREVIEW_LENGTH]))
+        offset = struct.unpack(endian + 'I', f.read(4) or b'\0\0\0\0')[0]
+    return previews
+
+def _jpeg_segments(f):
+    """ Yield (marker, length) of the header segments, f is at the payload """
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        while marker[:1] == b'\xff' and marker[1:2] == b'\xff': # fill bytes
+            marker = marker[1:] + f.read(1)
+        if len(marker) < 2 or marker[:1] != b'\xff':
+            return
+        m = ord(marker[1:2])
+        if m == 0xD8 or 0xD0 <= m <= 0xD7: # markers without payload
+            continue
+        if m in (0xD9, 0xDA): # EOI or start of scan: no more headers
+            return
+        length = struct.unpack('>H', f.read(2))[0]
+        start = f.tell()
+        yield m, length
+        f.seek(start + length - 2)
+
+def _parse_jpeg(f, meta):
+    for m, length in _jpeg_segments(f):
+        if m in JPEG_SOF:
+            meta.height, meta.width = struct.unpack('>xHH', f.read(5))
+            return # exif (APP1) always come before the frame header
+        if m == 0xE1 and f.read(6) == b'Exif\0\0':
+            exif = io.BytesIO(f.read(length - 8))
+            _parse_tiff(exif, 0, meta, TAGS_IFD0_JPEG)
+
+def _parse_png(f, meta):
+    f.seek(8)
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        length, ctype = struct.unpack('>I4s', head)
+        if ctype == b'IHDR':
+            meta.width, meta.height = struct.unpack('>II', f.read(8))
+            f.seek(length - 8 + 4, os.SEEK_CUR)
+        elif ctype == b'eXIf':
+            exif = io.BytesIO(f.read(length))
+            _parse_tiff(exif, 0, meta)
+            f.seek(4, os.SEEK_CUR)
+        elif ctype in (b'IDAT', b'IEND'):
+            return
+        else:
+            f.seek(length + 4, os.SEEK_CUR)
+
+@perf.timed('metadata.read')
+def read(path):
+    """ Read the Metadata of the image at path, without decoding it """
+    st = archives.stat(path)
+    meta = Metadata(path, st.st_mtime, st.st_size)
+    try:
+        with archives.open(path) as f:
+            head = f.read(26)
+            if head[:2] == b'\xff\xd8':
+                _parse_jpeg(f, meta)
+            elif head[:8] == b'\x89PNG\r\n\x1a\n':
+                _parse_png(f, meta)
+            elif head[:4] in (b'II*\0', b'MM\0*'):
+                _parse_tiff(f, 0, meta)
+            elif head[:6] in (b'GIF87a', b'GIF89a'):
+                meta.width, meta.height = struct.unpack('<HH', head[6:10])
+            elif head[:2] == b'BM':
+                w, h = struct.unpack('<ii', head[18:26])
+                meta.width, meta.height = w, abs(h)
+    except (IOError, struct.error, KeyError, ValueError) as e:
+        print("ERROR: Cannot read metadata of '%s': %s" % (path, e))
+    return meta
+
+
+@perf.timed('metadata.preview')
+def preview(path):
+    """ The biggest jpeg preview embedded in path, or None
+
+    Return (jpeg data, width, height). For jpeg files only the exif segment
+    is read, tiff based files (most of the raw formats) are seeked.
+    """
+    data = None
+    try:
+        with archives.open(path) as f:
+            head = f.read(4)
+            if head[:2] == b'\xff\xd8':
+                for m, length in _jpeg_segments(f):
+                    if m == 0xE1 and f.read(6) == b'Exif\0\0':
+                        f = io.BytesIO(f.read(length - 8))
+                        break
+                    if m in JPEG_SOF:
+                        return None
+                else:
+                    return None
+            elif head not in (b'II*\0', b'MM\0*'):
+                return None
+            previews = _tiff_previews(f, 0)
+            if previews:
+                offset, length = max(previews, key=lambda p: p[1])
+                f.seek(offset)
+                data = f.read(length)
+    except (IOError, struct.error) as e:
+        print("ERROR: Cannot read the preview of '%s': %s" % (path, e))
+        return None
+    if not data or data[:2] != b'\xff\xd8':
+        return None
+    meta = Metadata(path, 0, len(data))
+    try:
+        _parse_jpeg(io.BytesIO(data), meta)
+    except struct.error:
+        return None
+    if not meta.width or not meta.height:
+        return None
+    return data, meta.width, meta.height
+
+
+# the memory cache only keep the recently used photos, about 400 bytes each
+META_BYTES = 400
+_cache = LRUCache(16 * 1024 * 1024, name='metadata.cache') # path -> Metadata
+
+def get(path):
+    """ The Metadata of path, from the caches if the file is unchanged
+
+    Files are read only once, the memory cache is backed by the catalog.
+    """
+    mtime = archives.stat(path).st_mtime
+    meta = _cache.get(path)
+    if meta is not None and meta.mtime == mtime:
+        perf.count('metadata.hit')
+        return meta
+    row = catalog.instance().image_get(path, mtime)
+    if row is not None:
+        perf.count('metadata.catalog')
+        meta = Metadata.from_row(row)
+    else:
+        perf.count('metadata.miss')
+        meta = read(path)
+        catalog.instance().images_set([meta.to_row()])
+    _cache.put(path, meta, META_BYTES)
+    return meta
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" The list of photos shown by the grid and by the slideshow
+
+A single FolderModel is shared by the two widgets: every photo is one small
+Photo record, used as the data of the widget items, so that nothing is
+duplicated per photo. The slideshow only create items around the current
+photo, looking up the others here.
+
+Photos are in natural name order, unless sorted by one of the other
+SORT_MODES. The sort keys come from the metadata stored in the catalog,
+so sorting never touch the files: the photos never read before go last,
+until their metadata is read in background (see scanner.MetadataReader).
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import time
+
+import eluminance.files as files
+import eluminance.catalog as catalog
+import eluminance.metadata as metadata
+
+
+SORT_MODES = ('name', 'date', 'mtime', 'size', 'pixels')
+
+
+class Photo(object):
+    """ A photo of the model """
+    __slots__ = ('path',)
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def __repr__(self):
+        return 'Photo(%r)' % self.path
+
+
+def _photo_name(photo):
+    return photo.name
+
+def _path_key(path):
+    """ Natural order of full paths, the same of scanner.walk_images """
+    return tuple(files.natural_key(part) for part in path.split(os.sep))
+
+def _row_date(row):
+    """ The exif date of a catalog row, or its mtime in the same format """
+    if row[6]:
+        return row[6]
+    return time.strftime('%Y:%m:%d %H:%M:%S', time.localtime(row[1]))
+
+def _sort_key(mode, photo, row, date):
+    """ Photos without metadata go last, in name order """
+    name = files.natural_key(photo.name)
+    if mode == 'name':
+        return name
+    if mode == 'path':
+        return _path_key(photo.path)
+    if row is None:
+        return (1, 0, name)
+    if mode == 'date':
+        val = date
+    elif mode == 'mtime':
+        val = row[1]
+    elif mode == 'size':
+        val = row[2] or 0
+    else:
+        val = (row[3] or 0) * (row[4] or 0)
+    return (0, val, name)
+
+
+class FolderModel(object):
+    """ The photos in display order, with lookup by path """
+    def __init__(self):
+        self.sort_mode = 'name'
+        self._photos = []  # Photo, in display order
+        self._by_path = {} # path -> Photo
+        self._index = {}   # Photo -> position in _photos, if < _valid
+        self._valid = 0    # positions before this one are up to date
+        self._keys = {}    # Photo -> sort key, when not sorted by name
+        self._dates = {}   # Photo -> date, since the last sort()
+        self._added = None # Photo, in added order, since the first sort()
+
+    def __len__(self):
+        return len(self._photos)
+
+    def __getitem__(self, index):
+        return self._photos[index]
+
+    def __iter__(self):
+        return iter(self._photos)
+
+    def __contains__(self, path):
+        return path in self._by_path
+
+    def get(self, path):
+        return self._by_path.get(path)
+
+    def clear(self):
+        self._photos = []
+        self._by_path = {}
+        self._index = {}
+        self._valid = 0
+        self._keys = {}
+        self._dates = {}
+        self._added = None
+
+    def append(self, paths):
+        """ Add the paths at the end, return the new Photo (known are skipped) """
+        added = []
+        for path in paths:
+            if path not in self._by_path:
+                photo = self._by_path[path] = Photo(path)
+                self._index[photo] = len(self._photos) + len(added)
+                added.append(photo)
+        if self._valid == len(self._photos):
+            self._valid += len(added)
+        self._photos.extend(added)
+        if self._added is not None:
+            self._added.extend(added)
+        return added
+
+    def insert(self, path):
+        """ Add path in its sorted position, return (pos, Photo) """
+        photo = Photo(path)
+        if self.sort_mode == 'name':
+            pos = files.natural_bisect(self._photos, os.path.basename(path),
+                                       _photo_name)
+        elif self.sort_mode == 'path':
+            key = _path_key(path)
+            lo, hi = 0, len(self._photos)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if _path_key(self._photos[mid].path) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            pos = lo
+        elif self.sort_mode == 'added':
+            pos = len(self._photos)
+        else:
+            try:
+                row = metadata.get(path).to_row()
+            except OSError:
+                row = None
+            date = self._dates[photo] = row and _row_date(row)
+            key = self._keys[photo] = _sort_key(self.sort_mode, photo,
+                                                row, date)
+            lo, hi = 0, len(self._photos)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._keys.get(self._photos[mid], key) <= key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            pos = lo
+        self._by_path[path] = photo
+        self._photos.insert(pos, photo)
+        self._index[photo] = pos
+        self._valid = min(self._valid, pos)
+        if self._added is not None:
+            self._added.append(photo)
+        return pos, photo
+
+    def remove(self, path):
+        """ Remove path, return (old position, Photo) """
+        photo = self._by_path.pop(path)
+        pos = self._index.pop(photo)
+        if pos >= self._valid:
+            pos = self._photos.index(photo, self._valid)
+        del self._photos[pos]
+        self._valid = min(self._valid, pos)
+        self._keys.pop(photo, None)
+        self._dates.pop(photo, None)
+        return pos, photo
+
+    def sort(self, mode):
+        """ Sort the photos by one of SORT_MODES
+
+        Or by 'path', the natural order of the full paths, for the photos
+        of many folders, or back in the order they were 'added'.
+        Return the paths of the photos put last because their metadata was
+        never read (only for the modes that need the metadata).
+        """
+        if self._added is None:
+            self._added = list(self._photos)
+        added = {}
+        if mode == 'added':
+            added = dict((photo, i) for i, photo in enumerate(self._added))
+        rows = catalog.instance().images_get([p.path for p in self._photos])
+        self._dates = {}
+        self._keys = {}
+        missing = []
+        for photo in self._photos:
+            row = rows.get(photo.path)
+            if row is None and mode in SORT_MODES[1:]:
+                missing.append(photo.path)
+            date = self._dates[photo] = row and _row_date(row)
+            if mode == 'added':
+                self._keys[photo] = added[photo]
+            else:
+                self._keys[photo] = _sort_key(mode, photo, row, date)
+        self._photos.sort(key=self._keys.__getitem__)
+        if mode not in SORT_MODES[1:]:
+            self._keys = {}
+        self.sort_mode = mode
+        self._valid = 0
+        self._reindex()
+        return missing
+
+    def day(self, photo):
+        """ The capture day of photo (YYYY-MM-DD), None if unknown """
+        date = self._dates.get(photo)
+        return date[:10].replace(':', '-') if date else None
+
+    def index(self, photo):
+        """ Position of photo """
+        pos = self._index[photo]
+        if pos >= self._valid:
+            self._reindex()
+            pos = self._index[photo]
+        return pos
+
+    def _reindex(self):
+        """ Update the positions moved by insert() and remove()
+
+        Done only when a position is needed, so that a burst of changes
+        costs a single update.
+        """
+        index, photos = self._index, self._photos
+        for pos in range(self._valid, len(photos)):
+            index[photos[pos]] = pos
+        self._valid = len(photos)
+
+    def around(self, pos, before, after, loop=False):
+        """ Positions of the photos around pos, in navigation order
+
+        When loop the positions wrap around the ends, if all the photos fit
+        they are all returned in order.
+        """
+        count = len(self._photos)
+        if loop and count > before + after + 1:
+            return [(pos + i) % count for i in range(-before, after + 1)]
+        if loop:
+            return list(range(count))
+        return list(range(max(0, pos - before), min(count, pos + after + 1)))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Timing of the hot paths and cache counters
+
+Disabled by default, in this case every call return at once. Once enabled
+the durations of each named section are collected in a Histogram and the
+counters are incremented, stats() and dump() report everything.
+
+usage:
+    @perf.timed('scan')
+    def scan(): ...
+
+    with perf.timer('decode'):
+        ...
+
+    perf.count('cache.hit')
+"""
+
+from __future__ import absolute_import, print_function
+
+import json
+import time
+import threading
+import functools
+from collections import deque
+
+
+timer_func = getattr(time, 'perf_counter', time.time)
+enabled = False
+
+_histograms = {} # name -> Histogram
+_counters = {}   # name -> int
+_lock = threading.Lock() # sections can be timed in the worker threads too
+
+
+class Histogram(object):
+    """ Durations of a section, percentiles are computed on the last ones """
+    SAMPLES = 2048
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def add(self, secs):
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+        self.samples.append(secs)
+
+    def stats(self):
+        """ Everything in milliseconds """
+        samples = sorted(self.samples) or [0.0]
+        def pct(p):
+            return samples[min(len(samples) - 1, len(samples) * p // 100)]
+        return {
+            'count': self.count,
+            'mean': self.total / self.count * 1000 if self.count else 0.0,
+            'max': self.max * 1000,
+            'p50': pct(50) * 1000,
+            'p95': pct(95) * 1000,
+            'p99': pct(99) * 1000,
+        }
+
+
+def enable(val=True):
+    global enabled
+    enabled = val
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+def record(name, secs):
+    """ Add a duration (in seconds) to the histogram of name """
+    if not enabled:
+        return
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = Histogram()
+        hist.add(secs)
+
+def count(name, num=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + num
+
+
+class _Timer(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer_func()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, timer_func() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_null_timer = _NullTimer()
+
+def timer(name):
+    """ Context manager that time its block """
+    return _Timer(name) if enabled else _null_timer
+
+def timed(name):
+    """ Decorator that time every call of the function """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kargs):
+            if not enabled:
+                return func(*args, **kargs)
+            start = timer_func()
+            try:
+                return func(*args, **kargs)
+            finally:
+                record(name, timer_func() - start)
+        return wrapper
+    return decorator
+
+
+def stats():
+    """ All the collected data, as a json friendly dict """
+    with _lock:
+        return {
+            'timings': dict((n, h.stats()) for n, h in _histograms.items()),
+            'counters': dict(_counters),
+        }
+
+def summary():
+    """ A short text report, one line per section and counter """
+    data = stats()
+    lines = []
+    for name, s in sorted(data['timings'].items()):
+        lines.append('%s: %d  p50 %.1f  p95 %.1f  p99 %.1f ms' %
+                     (name, s['count'], s['p50'], s['p95'], s['p99']))
+    for name, val in sorted(data['counters'].items()):
+        lines.append('%s: %d' % (name, val))
+    return lines
+
+def dump(path):
+    data = stats()
+    data['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+import os
+import time
+import heapq
+import threading
+try:
+    from queue import Queue, Empty, Full
+except ImportError: # python 2
+    from Queue import Queue, Empty, Full
+
+from efl import ecore
+
+import eluminance.files as files
+import eluminance.catalog as catalog
+import eluminance.archives as archives
+import eluminance.metadata as metadata
+import eluminance.perf as perf
+from eluminance.cache import LRUCache
+
+
+# a folder modified so recently could change again in the same mtime tick,
+# do not trust the mtime to validate the catalog in this case
+RACY_MTIME = 2.0
+
+# natural keys of the last folders read, about 200 bytes per name
+KEY_BYTES = 200
+_keys = LRUCache(64 * 1024 * 1024, name='scan.keys') # folder -> {name: key}
+_keys_lock = threading.Lock()
+
+
+@perf.timed('scan.read')
+def read_folder(path):
+    """ Read path from disk, return the unsorted (images, folders) names
+
+    Archives are listed as folders.
+    """
+    images, folders = [], []
+    for entry in files.scandir(path):
+        if entry.is_dir():
+            folders.append(entry.name)
+        elif files.is_image(entry.name):
+            images.append(entry.name)
+        elif archives.is_archive(entry.name):
+            folders.append(entry.name)
+    return images, folders
+
+def natural_keys(path, names):
+    """ The natural keys of the names read from path, as a dict
+
+    The keys of every folder listing are kept, so that when the folder is
+    read again after a change only the new names need a key.
+    """
+    with _keys_lock:
+        old = _keys.get(path) or {}
+    keys = {}
+    for name in names:
+        key = old.get(name)
+        keys[name] = key if key is not None else files.natural_key(name)
+    with _keys_lock:
+        _keys.put(path, keys, len(keys) * KEY_BYTES)
+    return keys
+
+def catalog_store(path, mtime, images, folders):
+    """ Save the sorted content of path in the catalog, if safe to do """
+    if time.time() - mtime > RACY_MTIME:
+        catalog.instance().folder_set(path, mtime, images, folders)
+
+def scan_folder(path):
+    """ Return the natural sorted (images, folders) names of path
+
+    The content is taken from the catalog when the folder is unchanged
+    since the last visit, otherwise it is read from disk and cached.
+    Archives, and the folders inside them, are listed from their index.
+    """
+    if archives.split(path) is not None:
+        return archives.listdir(path)
+    mtime = os.stat(path).st_mtime
+    cached = catalog.instance().folder_get(path, mtime)
+    if cached is not None:
+        perf.count('catalog.hit')
+        return cached
+    perf.count('catalog.miss')
+    images, folders = read_folder(path)
+    with perf.timer('scan.sort'):
+        keys = natural_keys(path, images + folders)
+        images.sort(key=keys.__getitem__)
+        folders.sort(key=keys.__getitem__)
+    catalog_store(path, mtime, images, folders)
+    return images, folders
+
+def has_subfolders(path):
+    """ True if path contains at least one (non hidden) folder
+
+    The catalog is used when possible, otherwise the folder is read only
+    up to the first subfolder found, using the entries type (no stat).
+    """
+    if archives.split(path) is not None:
+        return bool(archives.listdir(path)[1])
+    mtime = os.stat(path).st_mtime
+    cat = catalog.instance()
+    has = cat.subfolders_get(path, mtime)
+    if has is not None:
+        return has
+    has = False
+    for entry in files.scandir(path):
+        if entry.name[0] != '.' and (entry.is_dir() or
+                                     archives.is_archive(entry.name)):
+            has = True
+            break
+    if time.time() - mtime > RACY_MTIME:
+        cat.subfolders_set(path, mtime, has)
+    return has
+
+def _folder_runs(images, folders):
+    """ Split the natural sorted images at the natural sorted folders
+
+    Generate (images, folder) for the images that come before each folder in
+    natural order, the last pair has the images after all the folders and
+    None as folder.
+    """
+    start = 0
+    for folder in folders:
+        pos = max(start, files.natural_bisect(images, folder, _same))
+        yield images[start:pos], folder
+        start = pos
+    yield images[start:], None
+
+def _same(name):
+    return name
+
+def _walk_listing(folder, visited, in_archive):
+    """ The _folder_runs of a folder to walk, None if visited or unreadable """
+    try:
+        if in_archive:
+            images, folders = archives.listdir(folder)
+        else:
+            st = os.stat(folder)
+            if (st.st_dev, st.st_ino) in visited:
+                return None
+            visited.add((st.st_dev, st.st_ino))
+            images, folders = scan_folder(folder)
+    except OSError as e:
+        print("ERROR: Cannot scan folder '%s': %s" % (folder, e))
+        return None
+    folders = [f for f in folders if f[0] != '.' and
+               (in_archive or not archives.is_archive(f))]
+    return _folder_runs(images, folders)
+
+def walk_images(root, cancelled=None):
+    """ Generate (folder, images) for root and all the folders below it
+
+    Images are generated in natural order of their full paths: the images of
+    a folder are natural sorted together with its subfolders, every subfolder
+    is walked at its place among them, so a folder can be generated more than
+    once, each time with the images between two of its subfolders.
+    Hidden folders are skipped and each folder is visited only once, so that
+    symlink loops cannot trap the walk. Only the folders being walked are kept
+    in memory, never the images already generated.
+    The walk stops as soon as the cancelled Event is set.
+    Archives are not entered, unless root is (or is inside) one of them.
+    """
+    in_archive = archives.split(root) is not None
+    visited = set() # (st_dev, st_ino) of visited folders
+    stack = []      # (folder, _folder_runs) being walked
+    folder = root
+    while True:
+        if cancelled is not None and cancelled.is_set():
+            return
+        if folder is not None:
+            runs = _walk_listing(folder, visited, in_archive)
+            if runs is not None:
+                stack.append((folder, runs))
+        if not stack:
+            return
+        parent, runs = stack[-1]
+        images, folder = next(runs)
+        if folder is None:
+            stack.pop()
+        else:
+            folder = os.path.join(parent, folder)
+        if images:
+            yield parent, images
+
+
+class FolderScanner(object):
+    """ Scan a folder for images in a worker thread
+
+    The listing and the sorting are done in a separate thread, results are
+    then delivered to the main loop by an Animator, in batches that fit in
+    the frame budget, so that the ui never freeze, whatever the folder size.
+    Unchanged folders are taken from the catalog, otherwise the first screen
+    of photos is extracted with a partial sort and delivered before the full
+    sort is done.
+    """
+    FIRST_BATCH = 128  # enough photos to fill the first screen
+    CHUNK = 64         # photos per batch_cb call
+    MAX_QUEUED = 256   # batches, the worker wait when the ui is slower
+
+    def __init__(self, path, batch_cb, done_cb=None, recursive=False):
+        self.path = path
+        self.recursive = recursive
+        self._batch_cb = batch_cb
+        self._done_cb = done_cb
+        self._cancelled = threading.Event()
+        self._queue = Queue(self.MAX_QUEUED)
+        self._pending = []
+        self._start = perf.timer_func()
+        self._first_batch = True
+        # spend at most half of each frame adding items
+        self._budget = ecore.animator_frametime_get() / 2.0
+
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+        self._animator = ecore.Animator(self._animator_cb)
+
+    def cancel(self):
+        """ Stop the scan, no more callbacks will be called """
+        self._cancelled.set()
+        if self._animator is not None:
+            self._animator.delete()
+            self._animator = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    # worker thread
+    def _worker(self):
+        if self.recursive:
+            for folder, names in walk_images(self.path, self._cancelled):
+                self._put_chunks(names, folder)
+                self._seen(names, folder)
+            self._put(None)  # end of scan marker
+        else:
+            try:
+                names, delivered = self._scan()
+            except OSError as e:
+                print("ERROR: Cannot scan folder '%s': %s" % (self.path, e))
+                names, delivered = [], 0
+            self._put_chunks(names[delivered:], self.path)
+            self._put(None)  # end of scan marker
+            self._seen(names, self.path)
+
+    def _put_chunks(self, names, folder):
+        join = os.path.join
+        for i in range(0, len(names), self.CHUNK):
+            self._put([join(folder, n) for n in names[i:i+self.CHUNK]])
+
+    def _seen(self, names, folder):
+        # once delivered, so that the photos are not delayed by the inserts
+        if not self.cancelled:
+            join = os.path.join
+            catalog.instance().images_seen([join(folder, n) for n in names])
+
+    def _scan(self):
+        """ Return the sorted image names, and how many are delivered yet """
+        if archives.split(self.path) is not None:
+            return archives.listdir(self.path)[0], 0
+        mtime = os.stat(self.path).st_mtime
+        cached = catalog.instance().folder_get(self.path, mtime)
+        if cached is not None:
+            perf.count('catalog.hit')
+            return cached[0], 0
+        perf.count('catalog.miss')
+
+        images, folders = read_folder(self.path)
+        keys = natural_keys(self.path, images + folders)
+        first = []
+        if len(images) > self.FIRST_BATCH:
+            first = heapq.nsmallest(self.FIRST_BATCH, images,
+                                    key=keys.__getitem__)
+            self._put_chunks(first, self.path)
+        with perf.timer('scan.sort'):
+            images.sort(key=keys.__getitem__)
+            folders.sort(key=keys.__getitem__)
+        catalog_store(self.path, mtime, images, folders)
+        return images, len(first)
+
+    def _put(self, batch):
+        while not self.cancelled:
+            try:
+                self._queue.put(batch, timeout=0.2)
+                return
+            except Full:
+                pass
+
+    # main loop
+    def _animator_cb(self):
+        deadline = time.time() + self._budget
+        while time.time() < deadline:
+            if not self._pending:
+                try:
+                    self._pending = self._queue.get_nowait()
+                except Empty:
+                    return ecore.ECORE_CALLBACK_RENEW
+                if self._pending is None:  # scan completed
+                    perf.record('scan.total', perf.timer_func() - self._start)
+                    self._animator = None
+                    if self._done_cb:
+                        self._done_cb(self)
+                    return ecore.ECORE_CALLBACK_CANCEL
+            batch = self._pending[:self.CHUNK]
+            del self._pending[:self.CHUNK]
+            if self._first_batch:
+                self._first_batch = False
+                perf.record('scan.first_batch', perf.timer_func() - self._start)
+            self._batch_cb(batch)
+            if self.cancelled:  # cancelled from inside the callback
+                return ecore.ECORE_CALLBACK_CANCEL
+        return ecore.ECORE_CALLBACK_RENEW
+
+
+class SubfolderProber(object):
+    """ Find out in a worker thread which folders have subfolders
+
+    Folders are probed in request order, result_cb(path, has_subfolders)
+    is then called from the main loop for each of them.
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, result_cb):
+        self._result_cb = result_cb
+        self._requests = Queue()
+        self._results = Queue()
+        self._pending = 0
+        self._timer = None
+        self._thread = None  # started on first need
+
+    def probe(self, paths):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker)
+            self._thread.daemon = True
+            self._thread.start()
+        self._pending += len(paths)
+        for path in paths:
+            self._requests.put(path)
+        if self._timer is None:
+            self._timer = ecore.Timer(self.POLL_INTERVAL, self._poll_cb)
+
+    def clear(self):
+        """ Forget the probes not yet started """
+        while True:
+            try:
+                self._requests.get_nowait()
+            except Empty:
+                return
+            self._pending -= 1
+
+    # worker thread
+    def _worker(self):
+        while True:
+            path = self._requests.get()
+            try:
+                has = has_subfolders(path)
+            except OSError:
+                has = False
+            self._results.put((path, has))
+
+    # main loop
+    def _poll_cb(self):
+        while True:
+            try:
+                path, has = self._results.get_nowait()
+            except Empty:
+                break
+            self._pending -= 1
+            self._result_cb(path, has)
+        if self._pending <= 0:
+            self._pending = 0
+            self._timer = None
+            return ecore.ECORE_CALLBACK_CANCEL
+        return ecore.ECORE_CALLBACK_RENEW
+
+
+class MetadataReader(object):
+    """ Read the metadata of paths into the catalog, in a worker thread
+
+    Used for the photos that a sort by metadata had to put last, done_cb(self)
+    is then called from the main loop, to sort them again.
+    """
+    POLL_INTERVAL = 0.1
+    STORE_BATCH = 100 # rows per catalog transaction
+
+    def __init__(self, paths, done_cb):
+        self._paths = paths
+        self._done_cb = done_cb
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+        self._timer = ecore.Timer(self.POLL_INTERVAL, self._poll_cb)
+
+    def cancel(self):
+        """ Stop reading, done_cb will not be called """
+        self._cancelled.set()
+        if self._timer is not None:
+            self._timer.delete()
+            self._timer = None
+
+    # worker thread
+    def _worker(self):
+        cat = catalog.instance()
+        rows = []
+        for path in self._paths:
+            if self._cancelled.is_set():
+                break
+            try:
+                rows.append(metadata.read(path).to_row())
+            except OSError:
+                continue
+            if len(rows) >= self.STORE_BATCH:
+                cat.images_set(rows)
+                rows = []
+        cat.images_set(rows)
+        self._done.set()
+
+    # main loop
+    def _poll_cb(self):
+        if not self._done.is_set():
+            return ecore.ECORE_CALLBACK_RENEW
+        self._timer = None
+        self._done_cb(self)
+        return ecore.ECORE_CALLBACK_CANCEL
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Thumbnails management, following the freedesktop.org specification:
+https://specifications.freedesktop.org/thumbnail-spec/
+
+Thumbnails are shared with all the other compliant applications, they
+are stored in ~/.cache/thumbnails/SIZE/MD5_OF_URI.png and are valid while
+their Thumb::MTime text field match the mtime of the original file.
+The images inside the archives have no real file URI, their thumbnails are
+kept in the same way but in ~/.cache/eluminance/thumbnails, not shared.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import struct
+import hashlib
+import tempfile
+import multiprocessing
+try:
+    from urllib.parse import quote
+except ImportError: # python 2
+    from urllib import quote
+from xdg.BaseDirectory import xdg_cache_home
+
+import eluminance.perf as perf
+import eluminance.archives as archives
+from eluminance.workers import PoolService
+
+try:
+    from PIL import Image, PngImagePlugin
+except ImportError:
+    Image = None
+
+
+THUMBS_DIR = os.path.join(xdg_cache_home, 'thumbnails')
+FAIL_DIR = os.path.join(THUMBS_DIR, 'fail', 'eluminance-0.9')
+MEMBERS_DIR = os.path.join(xdg_cache_home, 'eluminance', 'thumbnails')
+SIZES = {'normal': 128, 'large': 256}
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+
+def available():
+    """ True if thumbnails can be generated (PIL is installed) """
+    return Image is not None
+
+def file_uri(path):
+    path = os.path.abspath(path)
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return 'file://' + quote(path)
+
+def thumb_name(path):
+    return hashlib.md5(file_uri(path).encode('utf-8')).hexdigest() + '.png'
+
+def thumb_path(path, size='normal'):
+    if archives.split(path) is not None:
+        return os.path.join(MEMBERS_DIR, size, thumb_name(path))
+    return os.path.join(THUMBS_DIR, size, thumb_name(path))
+
+def fail_path(path):
+    if archives.split(path) is not None:
+        return os.path.join(MEMBERS_DIR, 'fail', thumb_name(path))
+    return os.path.join(FAIL_DIR, thumb_name(path))
+
+def png_text(png_file):
+    """ Read the tEXt chunks of a png file, stopping at the image data """
+    text = {}
+    with open(png_file, 'rb') as f:
+        if f.read(8) != PNG_MAGIC:
+            return text
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                break
+            length, ctype = struct.unpack('>I4s', head)
+            if ctype == b'tEXt':
+                key, _, val = f.read(length).partition(b'\0')
+                text[key.decode('latin-1')] = val.decode('latin-1')
+                f.seek(4, os.SEEK_CUR)  # crc
+            elif ctype in (b'IDAT', b'IEND'):
+                break
+            else:
+                f.seek(length + 4, os.SEEK_CUR)
+    return text
+
+def thumb_valid(thumb, mtime):
+    """ True if thumb exists and was generated for a file with mtime """
+    try:
+        return png_text(thumb).get('Thumb::MTime') == str(int(mtime))
+    except (IOError, OSError, struct.error):
+        return False
+
+def thumb_lookup(path, size='normal'):
+    """ Return the path of a valid thumbnail for path, or None
+
+    A valid failure entry is reported as an empty string, meaning that the
+    file cannot be thumbnailed and that it is useless to try again.
+    """
+    try:
+        mtime = archives.stat(path).st_mtime
+    except OSError:
+        return ''
+    thumb = thumb_path(path, size)
+    if thumb_valid(thumb, mtime):
+        return thumb
+    if thumb_valid(fail_path(path), mtime):
+        return ''
+    return None
+
+def _save_png(img, dest, path, mtime, size):
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Thumb::URI', file_uri(path))
+    info.add_text('Thumb::MTime', str(int(mtime)))
+    info.add_text('Thumb::Size', str(size))
+    info.add_text('Software', 'Eluminance')
+
+    # write to a temp file and rename, to never expose partial thumbnails
+    dest_dir = os.path.dirname(dest)
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir, 0o700)
+    fd, tmp = tempfile.mkstemp(suffix='.png', dir=dest_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, 'PNG', pnginfo=info)
+        os.chmod(tmp, 0o600)
+        os.rename(tmp, dest)
+    except:
+        os.unlink(tmp)
+        raise
+
+def thumb_generate(path, size='normal'):
+    """ Create the thumbnail for path, return (path, thumb or '') """
+    px = SIZES[size]
+    try:
+        st = archives.stat(path)
+        with archives.open(path) as f:
+            img = Image.open(f)
+            img.draft('RGB', (px, px))  # let the jpeg decoder scale down for us
+            img.thumbnail((px, px), Image.BILINEAR)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'transparency' in img.info
+                                  else 'RGB')
+            thumb = thumb_path(path, size)
+            _save_png(img, thumb, path, st.st_mtime, st.st_size)
+        return path, thumb
+    except Exception as e:
+        print("ERROR: Cannot create thumbnail for '%s': %s" % (path, e))
+        try:
+            _save_png(Image.new('RGBA', (1, 1)), fail_path(path),
+                      path, st.st_mtime, st.st_size)
+        except Exception:
+            pass
+        return path, ''
+
+
+class ThumbnailService(PoolService):
+    """ Generate missing thumbnails using a pool of worker processes """
+
+    def __init__(self, workers=0, size='normal'):
+        PoolService.__init__(self, workers or multiprocessing.cpu_count())
+        self.size = size
+        self._requested = {}  # path -> request time, for the stats
+
+    def request(self, path, done_cb, *args):
+        """ Return a valid thumbnail (or '' for failed one) for path
+
+        If the thumbnail is not ready None is returned and its generation is
+        scheduled, done_cb(path, thumb, *args) will be called when ready.
+        """
+        with perf.timer('thumb.lookup'):
+            thumb = thumb_lookup(path, self.size)
+        if thumb is not None:
+            perf.count('thumb.hit')
+            return thumb
+        perf.count('thumb.miss')
+        self._requested.setdefault(path, perf.timer_func())
+        self._schedule(path, done_cb, args)
+        return None
+
+    def _job(self, path):
+        return thumb_generate, (path, self.size)
+
+    def _result(self, path, res):
+        try:
+            thumb = res.get()[1]
+        except Exception as e:
+            print("ERROR: Thumbnail worker failed: %s" % e)
+            thumb = ''
+        start = self._requested.pop(path, None)
+        if start is not None:
+            perf.record('thumb.generate', perf.timer_func() - start)
+        return thumb
+
+    def _dropped(self, path):
+        self._requested.pop(path, None)
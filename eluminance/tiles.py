@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" Multi resolution tile pyramids, to show huge images
+
+A pyramid is stored in ~/.cache/eluminance/tiles/MD5_OF_URI/ as:
+    LEVEL/ROW_COL.jpg  TILE pixels tiles, level 0 is the full resolution,
+                       every next level is half the size of the previous
+    preview.jpg        the whole image, at most PREVIEW pixels wide
+    info.json          size, levels and mtime of the original image,
+                       written last, a pyramid without it is incomplete
+Pyramids are valid while the original mtime is unchanged, the least
+recently used ones are removed when the cache gets too big.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import shutil
+from xdg.BaseDirectory import xdg_cache_home
+
+import eluminance.thumbnails as thumbnails
+from eluminance.workers import PoolService
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+TILES_DIR = os.path.join(xdg_cache_home, 'eluminance', 'tiles')
+TILE = 256
+PREVIEW = 1024
+
+
+def available():
+    """ True if pyramids can be built (PIL is installed) """
+    return Image is not None
+
+def pyramid_dir(path):
+    return os.path.join(TILES_DIR, thumbnails.thumb_name(path)[:-4])
+
+def tile_path(pyramid, level, row, col):
+    return os.path.join(pyramid, str(level), '%d_%d.jpg' % (row, col))
+
+def pyramid_lookup(path):
+    """ Return the info dict of a valid pyramid for path, or None
+
+    info keys: dir, width, height, levels, tile, mtime
+    """
+    pyramid = pyramid_dir(path)
+    info_file = os.path.join(pyramid, 'info.json')
+    try:
+        with open(info_file) as f:
+            info = json.load(f)
+        if info['mtime'] != os.stat(path).st_mtime:
+            return None
+        os.utime(info_file, None)  # mark as recently used
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    info['dir'] = pyramid
+    return info
+
+def pyramid_build(path, max_cache_bytes=0):
+    """ Create the pyramid for path, return its info dict (or None) """
+    Image.MAX_IMAGE_PIXELS = None  # huge images are the point here
+    pyramid = pyramid_dir(path)
+    tmp = '%s.tmp-%d' % (pyramid, os.getpid())
+    try:
+        mtime = os.stat(path).st_mtime
+        img = Image.open(path)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        width, height = img.size
+        level, preview = 0, False
+        os.makedirs(tmp)
+        while True:
+            w, h = img.size
+            if not preview and max(w, h) <= PREVIEW:
+                img.save(os.path.join(tmp, 'preview.jpg'), quality=85)
+                preview = True
+            os.makedirs(os.path.join(tmp, str(level)))
+            for row in range((h + TILE - 1) // TILE):
+                for col in range((w + TILE - 1) // TILE):
+                    box = (col * TILE, row * TILE,
+                           min(w, (col + 1) * TILE), min(h, (row + 1) * TILE))
+                    img.crop(box).save(tile_path(tmp, level, row, col),
+                                       quality=90)
+            if w <= TILE and h <= TILE:
+                break
+            if hasattr(img, 'reduce'): # Pillow >= 7
+                img = img.reduce(2)
+            else:
+                img = img.resize(((w + 1) // 2, (h + 1) // 2), Image.BILINEAR)
+            level += 1
+        del img
+
+        info = {'width': width, 'height': height, 'levels': level + 1,
+                'tile': TILE, 'mtime': mtime}
+        with open(os.path.join(tmp, 'info.json'), 'w') as f:
+            json.dump(info, f)
+        if os.path.exists(pyramid):
+            shutil.rmtree(pyramid)
+        os.rename(tmp, pyramid)
+    except Exception as e:
+        print("ERROR: Cannot build tiles for '%s': %s" % (path, e))
+        shutil.rmtree(tmp, ignore_errors=True)
+        return None
+    if max_cache_bytes:
+        cache_trim(max_cache_bytes, keep=pyramid)
+    info['dir'] = pyramid
+    return info
+
+def cache_trim(max_bytes, keep=None):
+    """ Remove the least recently used pyramids to fit in max_bytes """
+    pyramids = []
+    total = 0
+    for entry in os.listdir(TILES_DIR):
+        pyramid = os.path.join(TILES_DIR, entry)
+        size = 0
+        for folder, dirs, files in os.walk(pyramid):
+            size += sum(os.path.getsize(os.path.join(folder, f)) for f in files)
+        try:
+            used = os.path.getmtime(os.path.join(pyramid, 'info.json'))
+        except OSError:  # incomplete, maybe still in progress
+            used = os.path.getmtime(pyramid)
+            if time.time() - used < 3600:
+                continue
+        pyramids.append((used, pyramid, size))
+        total += size
+    for used, pyramid, size in sorted(pyramids):
+        if total <= max_bytes:
+            break
+        if pyramid != keep:
+            shutil.rmtree(pyramid, ignore_errors=True)
+            total -= size
+
+
+class PyramidService(PoolService):
+    """ Build the missing pyramids in a worker process, one at a time
+
+    A build goes on even if cancelled, as the pyramid will be useful later.
+    """
+    POLL_INTERVAL = 0.1
+    KEEP_CANCELLED = True
+
+    def __init__(self, max_cache_mb=2048):
+        PoolService.__init__(self, 1)
+        self.max_cache_bytes = max_cache_mb * 1024 * 1024
+
+    def request(self, path, done_cb, *args):
+        """ Return the info of a valid pyramid for path
+
+        If the pyramid is not ready None is returned and it is built in the
+        background, done_cb(path, info, *args) will be called when ready
+        (info is None if the build failed).
+        """
+        info = pyramid_lookup(path)
+        if info is not None:
+            return info
+        self._schedule(path, done_cb, args)
+        return None
+
+    def _job(self, path):
+        return pyramid_build, (path, self.max_cache_bytes)
+
+    def _result(self, path, res):
+        try:
+            return res.get()
+        except Exception as e:
+            print("ERROR: Tiles worker failed: %s" % e)
+            return None
@@ -20,8 +20,7 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
-import os
-import re
+import time
 from efl.ecore import Exe
 from efl.elementary import Icon
 
@@ -34,8 +33,8 @@ def clamp(low, val, high):
     if val > high: return high
     return val
 
-def file_hum_size(file_path):
-    bytes = float(os.path.getsize(file_path))
+def hum_size(bytes):
+    bytes = float(bytes)
     if bytes >= 1099511627776:
         terabytes = bytes / 1099511627776
         size = '%.1fT' % terabytes
@@ -52,10 +51,29 @@ def file_hum_size(file_path):
         size = '%.1fb' % bytes
     return size
 
-def natural_sort(l): 
-   convert = lambda text: int(text) if text.isdigit() else text.lower() 
-   alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)] 
-   return sorted(l, key=alphanum_key)
+class PhaseTimer(object):
+    """ Measure the time spent in consecutive phases (of the startup)
+
+    Every call to phase(name) close the phase started by the previous call
+    (or at start time). Nothing is measured if not enabled.
+    """
+    def __init__(self, enabled, start=None):
+        self.enabled = enabled
+        self.start = self._last = start or time.time()
+        self.phases = []  # (name, seconds)
+
+    def phase(self, name):
+        if self.enabled:
+            now = time.time()
+            self.phases.append((name, now - self._last))
+            self._last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        for name, secs in self.phases:
+            print('%-24s %8.1f ms' % (name, secs * 1000))
+        print('%-24s %8.1f ms' % ('total', (self._last - self.start) * 1000))
 
 
 class SafeIcon(Icon):
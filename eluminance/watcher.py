@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from efl import ecore
+
+
+# inotify events, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+             IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEAD = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+class FolderWatcher(object):
+    """ Watch folders for changes using inotify
+
+    Events are coalesced: changed_cb(folder, names, renames) is called once
+    per folder, at most every DELAY seconds, with the set of the changed
+    entry names and a list of (old_name, new_name) for the renames made
+    inside the folder. The callback must check on disk the actual state of
+    each name. names is None if the kernel dropped events, in this case the
+    whole folder must be read again.
+    Files are reported when closed after writing, never while still being
+    written, folders as soon as they are created.
+    Watches are reference counted, on systems without inotify nothing is
+    ever reported.
+    """
+    DELAY = 0.25
+
+    def __init__(self, changed_cb):
+        self._changed_cb = changed_cb
+        self._wds = {}      # wd -> folder
+        self._folders = {}  # folder -> [wd, refcount]
+        self._pending = {}  # folder -> set of names, or None for overflow
+        self._renames = {}  # folder -> list of (old_name, new_name)
+        self._moves = {}    # cookie -> (folder, old_name)
+        self._timer = None
+        self._handler = None
+        self._fd = -1
+        self._libc = None
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                     use_errno=True)
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            print("ERROR: inotify not available: %s" % e)
+            return
+        if fd < 0:
+            print("ERROR: inotify not available: %s" %
+                  os.strerror(ctypes.get_errno()))
+            return
+        self._fd = fd
+        self._handler = ecore.FdHandler(fd, ecore.ECORE_FD_READ, self._read_cb)
+
+    def shutdown(self):
+        if self._timer is not None:
+            self._timer.delete()
+            self._timer = None
+        if self._handler is not None:
+            self._handler.delete()
+            self._handler = None
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._wds = {}
+        self._folders = {}
+
+    def watch(self, folder):
+        if self._fd < 0:
+            return
+        if folder in self._folders:
+            self._folders[folder][1] += 1
+            return
+        path = folder.encode(sys.getfilesystemencoding()) \
+               if not isinstance(folder, bytes) else folder
+        wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                print("ERROR: Too many watched folders, see "
+                      "/proc/sys/fs/inotify/max_user_watches")
+            elif err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                print("ERROR: Cannot watch '%s': %s" %
+                      (folder, os.strerror(err)))
+            return
+        # the same inode can be reached by different paths (symlinks),
+        # the kernel return the same wd in this case
+        if wd in self._wds:
+            return
+        self._wds[wd] = folder
+        self._folders[folder] = [wd, 1]
+
+    def unwatch(self, folder):
+        watch = self._folders.get(folder)
+        if watch is None:
+            return
+        watch[1] -= 1
+        if watch[1] > 0:
+            return
+        del self._folders[folder]
+        del self._wds[watch[0]]
+        self._pending.pop(folder, None)
+        self._renames.pop(folder, None)
+        self._libc.inotify_rm_watch(self._fd, watch[0])
+
+    def _read_cb(self, fdh):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                print("ERROR: Cannot read inotify events: %s" % e)
+            return ecore.ECORE_CALLBACK_RENEW
+
+        pos, size = 0, len(data)
+        while pos + EVENT_HEAD.size <= size:
+            wd, mask, cookie, length = EVENT_HEAD.unpack_from(data, pos)
+            pos += EVENT_HEAD.size
+            name = data[pos:pos+length].rstrip(b'\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                for folder in self._folders:
+                    self._pending[folder] = None
+                continue
+            folder = self._wds.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED: # the folder is gone, so is the watch
+                del self._wds[wd]
+                self._folders.pop(folder, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue # reported by the parent folder, if watched
+            if mask & IN_CREATE and not mask & IN_ISDIR:
+                continue # wait for IN_CLOSE_WRITE
+            if not isinstance(folder, bytes):
+                name = name.decode(sys.getfilesystemencoding(), 'replace')
+            if mask & IN_MOVED_FROM:
+                self._moves[cookie] = (folder, name)
+            elif mask & IN_MOVED_TO and cookie in self._moves:
+                src_folder, src_name = self._moves.pop(cookie)
+                if src_folder == folder:
+                    self._renames.setdefault(folder, []).append(
+                        (src_name, name))
+            names = self._pending.setdefault(folder, set())
+            if names is not None:
+                names.add(name)
+
+        if self._pending and self._timer is None:
+            self._timer = ecore.Timer(self.DELAY, self._flush_cb)
+        return ecore.ECORE_CALLBACK_RENEW
+
+    def _flush_cb(self):
+        self._timer = None
+        pending, self._pending = self._pending, {}
+        renames, self._renames = self._renames, {}
+        self._moves = {} # unpaired moves are just adds/removes
+        for folder, names in pending.items():
+            self._changed_cb(folder, names, renames.get(folder, []))
+        return ecore.ECORE_CALLBACK_CANCEL
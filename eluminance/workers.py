@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (C) 2015-2016 Davide Andreoli <dave@gurumeditation.it>
+#
+# This file is part of Eluminance.
+#
+# Eluminance is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# Eluminance is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Eluminance. If not, see <http://www.gnu.org/licenses/>.
+
+""" A pool of worker processes serving requests for paths
+
+Used for the slow jobs that must not block the main loop, as generating
+thumbnails or building tile pyramids.
+"""
+
+from __future__ import absolute_import, print_function
+
+import multiprocessing
+from collections import OrderedDict
+
+from efl import ecore
+
+
+class PoolService(object):
+    """ Run a job for each requested path in a pool of worker processes
+
+    Requests are served last-in first-out, so that the photos the user is
+    looking at right now are served first, and only a couple of jobs per
+    worker are queued in the pool, so that the requests cancelled meanwhile
+    can still be dropped (unless KEEP_CANCELLED).
+    Callbacks are always called from the main loop.
+    Subclasses give the job of a path in _job() and the value for the
+    callbacks in _result().
+    """
+    POLL_INTERVAL = 0.05
+    KEEP_CANCELLED = False # run the jobs nobody is waiting for anymore
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = None     # started on first need
+        self._waiting = OrderedDict()  # path -> None, newest at the end
+        self._running = {}    # path -> AsyncResult
+        self._callbacks = {}  # path -> list of (func, args)
+        self._timer = None
+
+    def shutdown(self):
+        if self._timer is not None:
+            self._timer.delete()
+            self._timer = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def cancel(self, path, done_cb, *args):
+        """ Forget a request, the job is dropped if not yet started """
+        callbacks = self._callbacks.get(path, [])
+        if (done_cb, args) in callbacks:
+            callbacks.remove((done_cb, args))
+        if not callbacks and path in self._waiting and \
+                not self.KEEP_CANCELLED:
+            del self._waiting[path]
+            del self._callbacks[path]
+            self._dropped(path)
+
+    def _schedule(self, path, done_cb, args):
+        """ Run the job of path, done_cb(path, result, *args) when done """
+        self._callbacks.setdefault(path, []).append((done_cb, args))
+        if path not in self._running:
+            self._waiting.pop(path, None)
+            self._waiting[path] = None
+            self._feed()
+
+    def _job(self, path):
+        """ The (function, args) to run in a worker for path """
+        raise NotImplementedError
+
+    def _result(self, path, res):
+        """ The result for the callbacks, from the AsyncResult res """
+        raise NotImplementedError
+
+    def _dropped(self, path):
+        """ Called when the job of path is dropped before being started """
+        pass
+
+    def _feed(self):
+        if self._pool is None:
+            if hasattr(multiprocessing, 'get_context'):
+                # do not fork the whole efl application
+                ctx = multiprocessing.get_context('spawn')
+            else:
+                ctx = multiprocessing
+            self._pool = ctx.Pool(self.workers)
+        while self._waiting and len(self._running) < self.workers * 2:
+            path, _ = self._waiting.popitem(last=True)
+            self._running[path] = self._pool.apply_async(*self._job(path))
+        if self._running and self._timer is None:
+            self._timer = ecore.Timer(self.POLL_INTERVAL, self._poll_cb)
+
+    def _poll_cb(self):
+        done = [p for p, res in self._running.items() if res.ready()]
+        for path in done:
+            result = self._result(path, self._running.pop(path))
+            for func, args in self._callbacks.pop(path, []):
+                func(path, result, *args)
+        if done:
+            self._feed()
+        if not self._running:
+            self._timer = None
+            return ecore.ECORE_CALLBACK_CANCEL
+        return ecore.ECORE_CALLBACK_RENEW